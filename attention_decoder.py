@@ -3,6 +3,7 @@ from __future__ import division
 from __future__ import print_function
 import tensorflow as tf
 
+from tensorflow.contrib.layers.python.layers import initializers
 from tensorflow.contrib.layers.python.layers import layers
 from tensorflow.python.ops import rnn_cell_impl
 from tensorflow.python.framework import dtypes
@@ -16,6 +17,7 @@ from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import nn_ops
 from tensorflow.python.ops import variable_scope
 from tensorflow.python.util import nest
+import quantization
 
 def attention_decoder_fn_train(encoder_state,
                                                              attention_keys,
@@ -74,7 +76,14 @@ def attention_decoder_fn_inference(output_fn,
                                                                      dtype=dtypes.int32,
                                                                      selector_fn=None,
                                                                      imem=None,
+                                                                     sample_fn=None,
+                                                                     shortlist=None,
+                                                                     full_output_fn=None,
+                                                                     fallback_threshold=0.,
+                                                                     samples_per_post=1,
                                                                      name=None):
+    # with samples_per_post, encoder_state has that many consecutive rows per
+    # row of the memories and of imem (see _multi_memory_attention)
     with ops.name_scope(name, "attention_decoder_fn_inference", [
             output_fn, encoder_state, attention_keys, attention_values,
             attention_score_fn, attention_construct_fn, embeddings, imem,
@@ -91,6 +100,7 @@ def attention_decoder_fn_inference(output_fn,
             output_fn = lambda x: x
         if batch_size is None:
             batch_size = array_ops.shape(encoder_info)[0]
+        memory_rows = array_ops.reshape(math_ops.range(batch_size, dtype=dtype) // samples_per_post, [-1, 1])
 
     def decoder_fn(time, cell_state, cell_input, cell_output, context_state):
         with ops.name_scope(
@@ -105,17 +115,19 @@ def attention_decoder_fn_inference(output_fn,
                         [batch_size,], dtype=dtype) * (start_of_sequence_id)
                 done = array_ops.zeros([batch_size,], dtype=dtypes.bool)
                 cell_state = encoder_state
+                # the logits emitted per step, over the shortlist and the
+                # words outside it if there is one (see shortlist_output_fn)
                 cell_output = array_ops.zeros(
-                        [num_decoder_symbols], dtype=dtypes.float32)
+                        [num_decoder_symbols if shortlist is None else array_ops.size(shortlist) + 1], dtype=dtypes.float32)
                 word_input = array_ops.gather(embeddings, next_input_id)
                 naf_triple_id = array_ops.zeros([batch_size, 2], dtype=dtype)
-                triple_input = array_ops.gather_nd(imem[1], naf_triple_id)
+                triple_input = math_ops.cast(array_ops.gather_nd(imem[1], naf_triple_id), dtypes.float32)
                 cell_input = array_ops.concat([word_input, triple_input], axis=1)
 
                 # init attention
                 attention = _init_attention(encoder_state)
                 if imem is not None:
-                    context_state = tensor_array_ops.TensorArray(dtype=dtypes.int32, tensor_array_name="output_ids_ta", size=maximum_length, dynamic_size=True, infer_shape=False)
+                    context_state = tensor_array_ops.TensorArray(dtype=dtypes.int32, tensor_array_name="output_ids_ta", size=math_ops.reduce_max(maximum_length), dynamic_size=True, infer_shape=False)
             else:
                 # construct attention
                 attention = attention_construct_fn(cell_output, attention_keys,
@@ -128,13 +140,34 @@ def attention_decoder_fn_inference(output_fn,
                     logit = output_fn(cell_output)
                     word_prob = nn_ops.softmax(logit) * (1 - selector)
                     entity_prob = alignment * selector
-                    mask = array_ops.reshape(math_ops.cast(math_ops.greater(tf.reduce_max(word_prob, 1), tf.reduce_max(entity_prob, 1)), dtype=dtypes.float32), [-1,1])
-                    word_input = mask * array_ops.gather(embeddings, math_ops.cast(math_ops.argmax(word_prob, 1), dtype=dtype)) + (1 - mask) * array_ops.gather_nd(imem[0], array_ops.concat([array_ops.reshape(math_ops.range(batch_size, dtype=dtype), [-1,1]), array_ops.reshape(math_ops.cast(math_ops.argmax(entity_prob, 1), dtype=dtype), [-1,1])], axis=1))
-                    indices = array_ops.concat([array_ops.reshape(math_ops.range(batch_size, dtype=dtype), [-1,1]), math_ops.cast(1-mask, dtype=dtype) * tf.reshape(math_ops.cast(math_ops.argmax(alignment, 1), dtype=dtype), [-1, 1])], axis=1)
-                    triple_input = array_ops.gather_nd(imem[1], indices)
+                    if shortlist is not None:
+                        # the last column estimates the words outside the
+                        # shortlist, so word_prob is normalized like over the
+                        # full vocabulary and compares with entity_prob
+                        word_prob, other_prob = array_ops.split(word_prob, [array_ops.size(shortlist), 1], axis=1)
+                    if sample_fn is None:
+                        word_id = math_ops.cast(math_ops.argmax(word_prob, 1), dtype=dtype)
+                        word_max_prob = tf.reduce_max(word_prob, 1)
+                        if shortlist is not None:
+                            word_id = array_ops.gather(shortlist, word_id)
+                            if fallback_threshold > 0:
+                                word_id, word_max_prob = _shortlist_fallback(word_id, word_max_prob, array_ops.reshape(other_prob, [-1]),
+                                        full_output_fn, cell_output, selector, fallback_threshold, dtype)
+                        entity_id = math_ops.cast(math_ops.argmax(entity_prob, 1), dtype=dtype)
+                        mask = array_ops.reshape(math_ops.cast(math_ops.greater(word_max_prob, tf.reduce_max(entity_prob, 1)), dtype=dtypes.float32), [-1,1])
+                    else:
+                        # draw from the joint word/entity distribution, so the
+                        # selector decision is sampled together with the token
+                        choice = math_ops.cast(sample_fn(array_ops.concat([word_prob, entity_prob], 1)), dtype=dtype)
+                        word_id = math_ops.minimum(choice, num_decoder_symbols - 1)
+                        entity_id = math_ops.maximum(choice - num_decoder_symbols, 0)
+                        mask = array_ops.reshape(math_ops.cast(math_ops.less(choice, num_decoder_symbols), dtype=dtypes.float32), [-1,1])
+                    word_input = mask * array_ops.gather(embeddings, word_id) + (1 - mask) * math_ops.cast(array_ops.gather_nd(imem[0], array_ops.concat([memory_rows, array_ops.reshape(entity_id, [-1,1])], axis=1)), dtypes.float32)
+                    indices = array_ops.concat([memory_rows, math_ops.cast(1-mask, dtype=dtype) * tf.reshape(entity_id, [-1, 1])], axis=1)
+                    triple_input = math_ops.cast(array_ops.gather_nd(imem[1], indices), dtypes.float32)
                     cell_input = array_ops.concat([word_input, triple_input], axis=1)
                     mask = array_ops.reshape(math_ops.cast(mask, dtype=dtype), [-1])
-                    input_id = mask * math_ops.cast(math_ops.argmax(word_prob, 1), dtype=dtype) + (mask - 1) * math_ops.cast(math_ops.argmax(entity_prob, 1), dtype=dtype)
+                    input_id = mask * word_id + (mask - 1) * entity_id
                     context_state = context_state.write(time-1, input_id)
                     done = array_ops.reshape(math_ops.equal(input_id, end_of_sequence_id), [-1])
                     cell_output = logit
@@ -152,11 +185,9 @@ def attention_decoder_fn_inference(output_fn,
             # combine cell_input and attention
             next_input = array_ops.concat([cell_input, attention], 1)
 
-            # if time > maxlen, return all true vector
-            done = control_flow_ops.cond(
-                    math_ops.greater(time, maximum_length),
-                    lambda: array_ops.ones([batch_size,], dtype=dtypes.bool),
-                    lambda: done)
+            # if time > maxlen, the row is done; maximum_length is either a
+            # scalar or a [batch_size] vector of per-example caps
+            done = math_ops.logical_or(done, math_ops.greater(time, maximum_length))
             return (done, cell_state, next_input, cell_output, context_state)
 
     return decoder_fn
@@ -314,52 +345,129 @@ def prepare_attention(attention_states,
                           num_units,
                           imem=None,
                           output_alignments=False,
-                          reuse=False):
+                          reuse=False,
+                          inline_scores=False,
+                          quantized=False,
+                          recompute=False,
+                          memory_dtype=dtypes.float32):
+    if memory_dtype != dtypes.float32 and (attention_option != "bahdanau" or type(imem) is not tuple):
+        raise ValueError("Reduced precision memories need bahdanau attention over the graph and triple memories")
     # Prepare attention keys / values from attention_states
     with variable_scope.variable_scope("attention_keys", reuse=reuse) as scope:
-        attention_keys = layers.linear(
-            attention_states, num_units, biases_initializer=None, scope=scope)
+        attention_keys = _memory_linear(attention_states, num_units, scope, quantized, memory_dtype)
         attention_values = attention_states
 
     if imem is not None:
         if type(imem) is tuple:
             with variable_scope.variable_scope("imem_graph", reuse=reuse) as scope:
-                attention_keys2, attention_states2 = array_ops.split(layers.linear(
-                    imem[0], num_units*2, biases_initializer=None, scope=scope), [num_units, num_units], axis=2)
+                attention_keys2, attention_states2 = array_ops.split(_memory_linear(
+                    imem[0], num_units*2, scope, quantized, memory_dtype), [num_units, num_units], axis=2)
             with variable_scope.variable_scope("imem_triple", reuse=reuse) as scope:
-                attention_keys3, attention_states3 = array_ops.split(layers.linear(
-                    imem[1], num_units*2, biases_initializer=None, scope=scope), [num_units, num_units], axis=3)
+                attention_keys3, attention_states3 = array_ops.split(_memory_linear(
+                    imem[1], num_units*2, scope, quantized, memory_dtype), [num_units, num_units], axis=3)
             attention_keys = (attention_keys, attention_keys2, attention_keys3)
             attention_values = (attention_states, attention_states2, attention_states3)
         else:
             with variable_scope.variable_scope("imem", reuse=reuse) as scope:
-                attention_keys2, attention_states2 = array_ops.split(layers.linear(
-                    imem, num_units*2, biases_initializer=None, scope=scope), [num_units, num_units], axis=2)
+                attention_keys2, attention_states2 = array_ops.split(quantization.linear(
+                    imem, num_units*2, biases_initializer=None, scope=scope, quantized=quantized), [num_units, num_units], axis=2)
                 attention_keys = (attention_keys, attention_keys2)
                 attention_values = (attention_states, attention_states2)
 
-        
+    if memory_dtype != dtypes.float32:
+        # the memories live through the whole decoder loop, see _multi_memory_attention
+        attention_keys = nest.map_structure(lambda x: math_ops.cast(x, memory_dtype), attention_keys)
+        attention_values = nest.map_structure(lambda x: math_ops.cast(x, memory_dtype), attention_values)
 
     # Attention score function
     if imem is None:
         attention_score_fn = _create_attention_score_fn("attention_score", num_units,
-                                                            attention_option, reuse)
+                                                            attention_option, reuse, inline_scores=inline_scores)
     else:
         attention_score_fn = (_create_attention_score_fn("attention_score", num_units,
-                                                            attention_option, reuse),
+                                                            attention_option, reuse, inline_scores=inline_scores),
                             _create_attention_score_fn("imem_score", num_units,
-                                                            "luong", reuse, output_alignments=output_alignments))
+                                                            "luong", reuse, output_alignments=output_alignments, inline_scores=inline_scores))
 
     # Attention construction function
-    attention_construct_fn = _create_attention_construct_fn("attention_construct",
-                                  num_units,
-                                  attention_score_fn,
-                                  reuse)
+    if recompute and (attention_option != "bahdanau" or type(imem) is not tuple or quantized):
+        raise ValueError("Recomputed attention needs bahdanau attention over the graph and triple memories in float")
+    if attention_option == "bahdanau" and type(imem) is tuple:
+        attention_construct_fn = _create_multi_memory_construct_fn("attention_construct",
+                                      num_units,
+                                      reuse,
+                                      inline_scores=inline_scores,
+                                      quantized=quantized,
+                                      recompute=recompute)
+    else:
+        attention_construct_fn = _create_attention_construct_fn("attention_construct",
+                                      num_units,
+                                      attention_score_fn,
+                                      reuse,
+                                      quantized=quantized)
 
     return (attention_keys, attention_values, attention_score_fn,
                     attention_construct_fn)
 
 
+def _memory_linear(inputs, num_outputs, scope, quantized=False, dtype=dtypes.float32):
+    # the bias-free projection of a memory, computed in the storage type of
+    # the memories on the float variables of layers.linear, so no float32
+    # copy of a reduced precision memory is made
+    if quantized or dtype == dtypes.float32:
+        return math_ops.cast(quantization.linear(math_ops.cast(inputs, dtypes.float32), num_outputs,
+                biases_initializer=None, scope=scope, quantized=quantized), dtype)
+    num_inputs = inputs.get_shape()[-1].value
+    weights = variable_scope.get_variable("weights", [num_inputs, num_outputs], dtypes.float32,
+            initializer=initializers.xavier_initializer())
+    outputs = math_ops.matmul(array_ops.reshape(math_ops.cast(inputs, dtype), [-1, num_inputs]), math_ops.cast(weights, dtype))
+    return array_ops.reshape(outputs, array_ops.concat([array_ops.shape(inputs)[:-1], [num_outputs]], 0))
+
+
+def create_sample_fn(temperature=1.0, top_k=0, top_p=1.0):
+    # Draws one id per row from probs: [batch_size, num_choices].
+    # top_k = 0 and top_p = 1.0 leave the distribution untruncated.
+    temperature = ops.convert_to_tensor(temperature, dtypes.float32)
+    top_k = ops.convert_to_tensor(top_k, dtypes.int32)
+    top_p = ops.convert_to_tensor(top_p, dtypes.float32)
+
+    def sample_fn(probs):
+        num_choices = array_ops.shape(probs)[1]
+        logits = math_ops.log(probs + 1e-20) / temperature
+        min_logits = array_ops.ones_like(logits) * logits.dtype.min
+
+        def truncate_top_k():
+            values, _ = nn_ops.top_k(logits, math_ops.minimum(top_k, num_choices))
+            return array_ops.where(logits < values[:, -1:], min_logits, logits)
+        logits = control_flow_ops.cond(top_k > 0, truncate_top_k, lambda: logits)
+
+        def truncate_top_p():
+            # keep the smallest set of choices whose mass reaches top_p
+            sorted_probs, _ = nn_ops.top_k(nn_ops.softmax(logits), num_choices)
+            mass_before = math_ops.cumsum(sorted_probs, axis=1, exclusive=True)
+            threshold = math_ops.reduce_min(array_ops.where(mass_before < top_p,
+                sorted_probs, array_ops.ones_like(sorted_probs)), axis=1, keep_dims=True)
+            return array_ops.where(nn_ops.softmax(logits) < threshold, min_logits, logits)
+        logits = control_flow_ops.cond(top_p < 1.0, truncate_top_p, lambda: logits)
+
+        return array_ops.reshape(tf.multinomial(logits, 1), [-1])
+
+    return sample_fn
+
+
+def _shortlist_fallback(word_id, word_max_prob, other_prob, full_output_fn, cell_output, selector, threshold, dtype):
+    # the rows whose estimated probability of the words outside the shortlist
+    # exceeds threshold are rescored over the full vocabulary, the other rows
+    # keep their shortlisted word; no rows cost an empty matmul
+    rows = array_ops.where(math_ops.greater(other_prob, threshold))
+    word_prob = nn_ops.softmax(full_output_fn(array_ops.gather_nd(cell_output, rows))) * (1 - array_ops.gather_nd(selector, rows))
+    shape = math_ops.cast(array_ops.shape(word_id), dtypes.int64)
+    rescored = math_ops.cast(array_ops.scatter_nd(rows, array_ops.ones_like(rows[:, 0], dtype=dtypes.int32), shape), dtypes.bool)
+    full_id = array_ops.scatter_nd(rows, math_ops.cast(math_ops.argmax(word_prob, 1), dtype=dtype), shape)
+    full_max_prob = array_ops.scatter_nd(rows, math_ops.reduce_max(word_prob, 1), shape)
+    return array_ops.where(rescored, full_id, word_id), array_ops.where(rescored, full_max_prob, word_max_prob)
+
+
 def _init_attention(encoder_state):
     # Multi- vs single-layer
     # TODO(thangluong): is this the best way to check?
@@ -377,7 +485,7 @@ def _init_attention(encoder_state):
     return attn
 
 
-def _create_attention_construct_fn(name, num_units, attention_score_fn, reuse):
+def _create_attention_construct_fn(name, num_units, attention_score_fn, reuse, quantized=False):
     with variable_scope.variable_scope(name, reuse=reuse) as scope:
 
         def construct_fn(attention_query, attention_keys, attention_values):
@@ -404,8 +512,8 @@ def _create_attention_construct_fn(name, num_units, attention_score_fn, reuse):
                 context = attention_score_fn(attention_query, attention_keys,
                                                                          attention_values)
                 concat_input = array_ops.concat([attention_query, context], 1)
-            attention = layers.linear(
-                    concat_input, num_units, biases_initializer=None, scope=scope)
+            attention = quantization.linear(
+                    concat_input, num_units, biases_initializer=None, scope=scope, quantized=quantized)
             if alignments is None:
                 return attention
             else:
@@ -414,17 +522,118 @@ def _create_attention_construct_fn(name, num_units, attention_score_fn, reuse):
         return construct_fn
 
 
+def _multi_memory_attention(query, query_w, score_v, keys, values, num_units, inline_scores=False):
+    """Contexts of the encoder, graph and triple memories and the triple alignments.
+
+    The scores and contexts of the tuple score functions in one pass: the
+    luong scores of the graph and triple memories share the query and, like
+    all the contexts, are batched matmuls over the memories rather than
+    broadcast products reduced over units, and the triple context is
+    reduced once over the final alignments of all the triples.
+
+    The memories may be stored in float16 (memory_dtype of
+    prepare_attention); the products with them are then computed in that
+    type and the softmaxes, alignments and contexts returned in float32.
+
+    The query may have several consecutive rows per memory row, e.g. the
+    samples of a post, which are scored against the memories of their row
+    as one group instead of copies of the memories.
+    """
+    keys, graph_keys, triple_keys = keys
+    values, graph_values, triple_values = values
+    dtype = values.dtype
+    down = lambda x: math_ops.cast(x, dtype)
+    up = lambda x: math_ops.cast(x, dtypes.float32)
+    # the queries of every memory row: [batch_size, samples, num_units]
+    triple_shape = array_ops.shape(triple_keys)
+    batch_size = triple_shape[0]
+    grouped_query = down(array_ops.reshape(query, [batch_size, -1, num_units]))
+    # encoder memory, bahdanau: [batch_size, samples, encoder_len]
+    projected_query = down(array_ops.reshape(math_ops.matmul(query, query_w), [batch_size, -1, 1, num_units]))
+    if inline_scores:
+        scores = _attn_add(down(score_v), array_ops.expand_dims(keys, 1), projected_query)
+    else:
+        scores = _attn_add_fun(down(score_v), array_ops.expand_dims(keys, 1), projected_query)
+    alignments = nn_ops.softmax(up(scores))
+    context0 = math_ops.matmul(down(alignments), values)
+    # graph and triple memories, luong: [batch_size, samples, triple_num(, triple_len)]
+    column_query = array_ops.transpose(grouped_query, [0, 2, 1])
+    graph_scores = array_ops.transpose(math_ops.matmul(graph_keys, column_query), [0, 2, 1])
+    graph_alignments = nn_ops.softmax(up(graph_scores))
+    triple_scores = array_ops.transpose(math_ops.matmul(array_ops.reshape(triple_keys, [batch_size, -1, num_units]), column_query), [0, 2, 1])
+    triple_alignments = nn_ops.softmax(array_ops.reshape(up(triple_scores), [batch_size, -1, triple_shape[1], triple_shape[2]]))
+    final_alignments = array_ops.expand_dims(graph_alignments, 3) * triple_alignments
+    context1 = math_ops.matmul(down(graph_alignments), graph_values)
+    context2 = math_ops.matmul(array_ops.reshape(down(final_alignments), [batch_size, -1, triple_shape[1] * triple_shape[2]]),
+            array_ops.reshape(triple_values, [batch_size, -1, num_units]))
+    contexts = [array_ops.reshape(up(context), [-1, num_units]) for context in [context0, context1, context2]]
+    return contexts, array_ops.reshape(final_alignments, [-1, triple_shape[1], triple_shape[2]])
+
+
+# The whole attention step on explicit weights. Called noinline, its
+# gradient recomputes the step from the inputs of the call, so a training
+# loop keeps only the query of every step for backprop instead of the
+# scores, alignments and contexts over all the memories.
+@function.Defun(func_name="attention_step_fun", noinline=True)
+def _attention_step_fun(query, query_w, score_v, keys, values, graph_keys, graph_values,
+        triple_keys, triple_values, construct_w):
+    num_units = array_ops.shape(construct_w)[1]
+    contexts, alignments = _multi_memory_attention(query, query_w, score_v, (keys, graph_keys, triple_keys),
+            (values, graph_values, triple_values), num_units, inline_scores=True)
+    return math_ops.matmul(array_ops.concat([query] + contexts, 1), construct_w), alignments
+
+
+def _create_multi_memory_construct_fn(name, num_units, reuse, inline_scores=False, quantized=False, recompute=False):
+    # construct_fn of prepare_attention with imem=(graph, triples), on the
+    # variables of its score functions, through _multi_memory_attention
+    with variable_scope.variable_scope("attention_score", reuse=True):
+        query_w = variable_scope.get_variable("attnW", [num_units, num_units])
+        score_v = variable_scope.get_variable("attnV", [num_units])
+    with variable_scope.variable_scope(name, reuse=reuse) as scope:
+        if recompute:
+            construct_w = variable_scope.get_variable("weights", [4 * num_units, num_units],
+                    initializer=initializers.xavier_initializer())
+
+    def construct_fn(attention_query, attention_keys, attention_values):
+        if recompute:
+            attention, alignments = _attention_step_fun(attention_query, query_w, score_v,
+                    attention_keys[0], attention_values[0], attention_keys[1], attention_values[1],
+                    attention_keys[2], attention_values[2], construct_w)
+            attention.set_shape([None, num_units])
+            return attention, alignments
+        contexts, alignments = _multi_memory_attention(attention_query, query_w, score_v,
+                attention_keys, attention_values, num_units, inline_scores=inline_scores)
+        attention = quantization.linear(array_ops.concat([attention_query] + contexts, 1), num_units,
+                biases_initializer=None, scope=scope, quantized=quantized)
+        return attention, alignments
+
+    return construct_fn
+
+
 # keys: [batch_size, attention_length, attn_size]
 # query: [batch_size, 1, attn_size]
-# return weights [batch_size, attention_length]
+# return weights [batch_size, attention_length]; with keys [batch_size, 1,
+# attention_length, attn_size] and query [batch_size, samples, 1, attn_size]
+# the weights are [batch_size, samples, attention_length]
+def _attn_add(v, keys, query):
+    return math_ops.reduce_sum(v * math_ops.tanh(keys + query), [-1])
+
+
+def _attn_mul(keys, query):
+    return math_ops.reduce_sum(keys * query, [2])
+
+
+# The noinline functions keep the scores out of the caller's graph, which
+# also keeps XLA from fusing them with the surrounding ops; the inline
+# versions above are used when the attention is compiled.
 @function.Defun(func_name="attn_add_fun", noinline=True)
 def _attn_add_fun(v, keys, query):
-    return math_ops.reduce_sum(v * math_ops.tanh(keys + query), [2])
+    return _attn_add(v, keys, query)
 
 
 @function.Defun(func_name="attn_mul_fun", noinline=True)
 def _attn_mul_fun(keys, query):
-    return math_ops.reduce_sum(keys * query, [2])
+    return _attn_mul(keys, query)
 
 
 def _create_attention_score_fn(name,
@@ -432,6 +641,7 @@ def _create_attention_score_fn(name,
                                    attention_option,
                                    reuse,
                                    output_alignments=False,
+                                   inline_scores=False,
                                    dtype=dtypes.float32):
     with variable_scope.variable_scope(name, reuse=reuse):
         if attention_option == "bahdanau":
@@ -455,13 +665,19 @@ def _create_attention_score_fn(name,
                     
 
                 # attn_fun
-                scores = _attn_add_fun(score_v, keys, query)
+                if inline_scores:
+                    scores = _attn_add(score_v, keys, query)
+                else:
+                    scores = _attn_add_fun(score_v, keys, query)
             elif attention_option == "luong":
                 # reshape query: [batch_size, 1, num_units]
                 query = array_ops.reshape(query, [-1, 1, num_units])
 
                 # attn_fun
-                scores = _attn_mul_fun(keys, query)
+                if inline_scores:
+                    scores = _attn_mul(keys, query)
+                else:
+                    scores = _attn_mul_fun(keys, query)
             else:
                 raise ValueError("Unknown attention option %s!" % attention_option)
 
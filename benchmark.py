@@ -0,0 +1,172 @@
+# Step times, latencies and memory recorded for the performance options,
+# each with the command that measures it. An option marked unverified has
+# no recorded measurement: its speedup is expected, not shown.
+#   use_jit               unverified  benchmark.py --compare=use_jit=False,True
+#   decode_length_policy  unverified  main.py decode_time in the .res of --decode_length_policy=fixed and =example
+#   shortlist             unverified  benchmark.py --modes=decode --shortlist_size=2000 --compare=shortlist=False,True
+#   recompute_attention   unverified  benchmark.py --modes=train --compare=recompute_attention=False,True, and --memory_profile for the memory
+#   fused attention       unverified  benchmark.py --modes=train,decode at f71c7ad and at its parent
+#   stream                unverified  main.py --raw_path --stream first_token_ms and step_ms against decode_ms without --stream
+#   memory_dtype          unverified  main.py --compare_memory_dtype --memory_dtype=float16, accuracy and decode_ms in memory_dtype_report
+import ast
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import constant_op
+from model import Model, _START_VOCAB
+import memory_model
+from memory_model import DIMS, MemoryCostModel, memory_report, parse_dims, profile_step
+
+tf.app.flags.DEFINE_integer("symbols", 30000, "vocabulary size.")
+tf.app.flags.DEFINE_integer("num_entities", 21471, "entitiy vocabulary size.")
+tf.app.flags.DEFINE_integer("num_relations", 44, "relation size.")
+tf.app.flags.DEFINE_integer("embed_units", 300, "Size of word embedding.")
+tf.app.flags.DEFINE_integer("trans_units", 100, "Size of trans embedding.")
+tf.app.flags.DEFINE_integer("units", 512, "Size of each model layer.")
+tf.app.flags.DEFINE_integer("layers", 2, "Number of layers in the model.")
+tf.app.flags.DEFINE_integer("batch_size", 100, "Batch size of the synthetic batches.")
+tf.app.flags.DEFINE_integer("encoder_len", 20, "Post length of the synthetic batches.")
+tf.app.flags.DEFINE_integer("decoder_len", 20, "Response length of the synthetic batches.")
+tf.app.flags.DEFINE_integer("triple_num", 10, "Subgraphs per post of the synthetic batches.")
+tf.app.flags.DEFINE_integer("triple_len", 30, "Triples per subgraph of the synthetic batches.")
+tf.app.flags.DEFINE_integer("shortlist_size", 0, "Symbols fed as the decoding shortlist of models built with shortlist=True.")
+tf.app.flags.DEFINE_integer("steps", 10, "Timed steps per mode.")
+tf.app.flags.DEFINE_integer("warmup", 2, "Untimed steps run before timing.")
+tf.app.flags.DEFINE_string("modes", "train,decode", "Comma-separated steps to time: train, decode.")
+tf.app.flags.DEFINE_string("memory_profile", "", "Comma-separated batch dims to profile the memory of each mode at instead of timing it, e.g. 50x20x20x10x30,100x20x20x10x30 for batch x encoder_len x decoder_len x triple_num x triple_len.")
+tf.app.flags.DEFINE_string("compare", "", "Model option and the values to benchmark it with, e.g. use_jit=False,True.")
+tf.app.flags.DEFINE_integer("intra_threads", 0, "Intra-op threads of the session, 0 for the default.")
+tf.app.flags.DEFINE_integer("inter_threads", 0, "Inter-op threads of the session, 0 for the default.")
+
+FLAGS = tf.app.flags.FLAGS
+
+def synthetic_vocab():
+    vocab = _START_VOCAB + ['w%d' % i for i in range(FLAGS.symbols - len(_START_VOCAB))]
+    entity_vocab = ['_NONE', '_PAD_H', '_PAD_R', '_PAD_T', '_NAF_H', '_NAF_R', '_NAF_T']
+    entity_vocab += ['e%d' % i for i in range(FLAGS.num_entities - len(entity_vocab))]
+    relation_vocab = ['r%d' % i for i in range(FLAGS.num_relations)]
+    return vocab, entity_vocab, relation_vocab
+
+def synthetic_batch(vocab, entity_vocab, relation_vocab, rng, dims=None):
+    # every dimension at its flag value unless given
+    dims = dims or dict([(name, getattr(FLAGS, name)) for name in DIMS])
+    return memory_model.synthetic_batch(dims, vocab[len(_START_VOCAB):], entity_vocab[7:], relation_vocab, rng)
+
+def init_model(sess, model, vocab, entity_vocab, relation_vocab):
+    sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+    sess.run(model.symbol2index.insert(constant_op.constant(vocab),
+        constant_op.constant(list(range(len(vocab))), dtype=tf.int64)))
+    sess.run(model.index2symbol.insert(constant_op.constant(
+        list(range(len(vocab))), dtype=tf.int64), constant_op.constant(vocab)))
+    sess.run(model.entity2index.insert(constant_op.constant(entity_vocab+relation_vocab),
+        constant_op.constant(list(range(len(entity_vocab)+len(relation_vocab))), dtype=tf.int64)))
+    sess.run(model.index2entity.insert(constant_op.constant(
+        list(range(len(entity_vocab)+len(relation_vocab))), dtype=tf.int64), constant_op.constant(entity_vocab+relation_vocab)))
+
+def time_steps(step_fn):
+    for _ in range(FLAGS.warmup):
+        step_fn()
+    start_time = time.time()
+    for _ in range(FLAGS.steps):
+        step_fn()
+    return (time.time() - start_time) / FLAGS.steps
+
+def decode_feed(model, batched_data):
+    input_feed = {model.posts: batched_data['posts'],
+            model.posts_length: batched_data['posts_length'],
+            model.triples: batched_data['triples'],
+            model.posts_triple: batched_data['posts_triple'],
+            model.entities: batched_data['entities']}
+    if FLAGS.shortlist_size > 0 and hasattr(model, 'shortlist'):
+        input_feed[model.shortlist] = np.arange(FLAGS.shortlist_size, dtype=np.int32)
+    return input_feed
+
+def profile_memory(sess, model, modes, vocab, entity_vocab, relation_vocab, rng):
+    # a report per mode on one step at each of the memory_profile dims; the
+    # training step computes the gradients but does not apply them
+    cost_model = MemoryCostModel(FLAGS.symbols, FLAGS.units, FLAGS.trans_units)
+    reports = []
+    for mode in modes:
+        profiles = []
+        for text in FLAGS.memory_profile.split(','):
+            dims = parse_dims(text)
+            batched_data = synthetic_batch(vocab, entity_vocab, relation_vocab, rng, dims)
+            if mode == 'train':
+                fetches = [model.sentence_ppx, model.batch_gradient_norm]
+                input_feed = {model.posts: batched_data['posts'],
+                        model.posts_length: batched_data['posts_length'],
+                        model.responses: batched_data['responses'],
+                        model.responses_length: batched_data['responses_length'],
+                        model.triples: batched_data['triples'],
+                        model.posts_triple: batched_data['posts_triple'],
+                        model.responses_triple: batched_data['responses_triple'],
+                        model.match_triples: batched_data['match_triples']}
+            elif mode == 'decode':
+                fetches, input_feed = model.generation, decode_feed(model, batched_data)
+            else:
+                raise ValueError("Unknown benchmark mode %s!" % mode)
+            sess.run(fetches, input_feed)
+            profiles.append((dims, ) + profile_step(sess, fetches, input_feed))
+        reports.append((mode, memory_report(cost_model, mode, profiles)))
+    return reports
+
+def benchmark(options):
+    modes = FLAGS.modes.split(',')
+    vocab, entity_vocab, relation_vocab = synthetic_vocab()
+    rng = np.random.RandomState(0)
+    config = tf.ConfigProto(intra_op_parallelism_threads=FLAGS.intra_threads,
+            inter_op_parallelism_threads=FLAGS.inter_threads)
+    times = []
+    with tf.Graph().as_default(), tf.Session(config=config) as sess:
+        model = Model(
+                FLAGS.symbols,
+                FLAGS.embed_units,
+                FLAGS.units,
+                FLAGS.layers,
+                embed=None,
+                num_entities=FLAGS.num_entities+FLAGS.num_relations,
+                num_trans_units=FLAGS.trans_units,
+                forward_only='train' not in modes,
+                inference_decoder='decode' in modes,
+                **options)
+        init_model(sess, model, vocab, entity_vocab, relation_vocab)
+        if FLAGS.memory_profile:
+            return profile_memory(sess, model, modes, vocab, entity_vocab, relation_vocab, rng)
+        batched_data = synthetic_batch(vocab, entity_vocab, relation_vocab, rng)
+        for mode in modes:
+            if mode == 'train':
+                step_fn = lambda: model.step_decoder(sess, batched_data)
+            elif mode == 'decode':
+                input_feed = decode_feed(model, batched_data)
+                step_fn = lambda: sess.run(model.generation, input_feed)
+            else:
+                raise ValueError("Unknown benchmark mode %s!" % mode)
+            times.append((mode, time_steps(step_fn)))
+    return times
+
+def parse_compare(compare):
+    name, values = compare.split('=')
+    options = []
+    for value in values.split(','):
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        options.append({name: value})
+    return options
+
+def main(_):
+    variants = parse_compare(FLAGS.compare) if FLAGS.compare else [{}]
+    print('batch %d, encoder_len %d, decoder_len %d, triple_num %d, triple_len %d' % (FLAGS.batch_size,
+        FLAGS.encoder_len, FLAGS.decoder_len, FLAGS.triple_num, FLAGS.triple_len))
+    for options in variants:
+        if FLAGS.memory_profile:
+            for mode, report in benchmark(options):
+                print('%s %s\n%s\n' % (' '.join(['%s=%s' % item for item in options.items()]) or 'default', mode, report))
+            continue
+        times = benchmark(options)
+        print('%s: %s' % (' '.join(['%s=%s' % item for item in options.items()]) or 'default',
+            ', '.join(['%s %.3fs/step' % (mode, t) for mode, t in times])))
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+class CheckpointIndex(object):
+    """Append-only record of the checkpoints written to a training directory.
+
+    Each line of the index is a JSON object with a `step` and any fields known
+    about that step so far (`path`, `dev_ppx`, ...). Later lines for the same
+    step update earlier ones, so the trainer and an evaluator can both append
+    to the same file without coordinating.
+    """
+    def __init__(self, train_dir, filename='checkpoint_index'):
+        self.path = '%s/%s' % (train_dir, filename)
+        self._lock = threading.Lock()
+
+    def add(self, step, **fields):
+        record = dict(fields)
+        record['step'] = int(step)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def entries(self):
+        records = {}
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line still being written by another process
+                    continue
+                records.setdefault(record['step'], {}).update(record)
+        return [records[step] for step in sorted(records)]
+
+    def available(self):
+        # checkpoints rotated out by max_to_keep stay in the index, skip them
+        return [entry for entry in self.entries()
+                if 'path' in entry and os.path.exists('%s.index' % entry['path'])]
+
+    def steps(self):
+        return [entry['step'] for entry in self.available()]
+
+    def path_of(self, step):
+        for entry in self.available():
+            if entry['step'] == step:
+                return entry['path']
+        return None
+
+    def latest(self):
+        available = self.available()
+        return available[-1]['path'] if available else None
+
+
+class AsyncSaver(object):
+    """Saver that snapshots the variables in memory and writes them in the background.
+
+    `save` copies every variable into a non-trainable shadow copy with one
+    session run and hands the shadow copies to a writer thread, so the
+    training loop can go on updating the live variables while the checkpoint
+    is written. Checkpoints are stored under the original variable names and
+    restore with the model's regular saver.
+    """
+    def __init__(self, var_list, index=None, **saver_kwargs):
+        names_to_saveables = {}
+        snapshot_ops = []
+        with tf.name_scope('checkpoint_snapshot'):
+            for var in var_list:
+                shadow = tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype),
+                        trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                        name=var.op.name.replace('/', '_'))
+                snapshot_ops.append(tf.assign(shadow, var))
+                names_to_saveables[var.op.name] = shadow
+        # hash tables are only written at initialization, save them as they are
+        for saveable in tf.get_collection(tf.GraphKeys.SAVEABLE_OBJECTS):
+            names_to_saveables[saveable.name] = saveable
+        self.snapshot_op = tf.group(*snapshot_ops)
+        self.saver = tf.train.Saver(names_to_saveables, **saver_kwargs)
+        self.index = index
+        self._thread = None
+        self._error = None
+
+    def save(self, sess, save_path, global_step, **fields):
+        self.join()
+        sess.run(self.snapshot_op)
+        self._thread = threading.Thread(target=self._write,
+                args=(sess, save_path, int(global_step), fields))
+        self._thread.start()
+
+    def _write(self, sess, save_path, global_step, fields):
+        try:
+            path = self.saver.save(sess, save_path, global_step=global_step)
+            if self.index is not None:
+                self.index.add(global_step, path=path, **fields)
+        except Exception as e:
+            self._error = e
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+def transform_checkpoint(checkpoint_path, save_path, transform_fn, global_step=None):
+    """Writes a copy of a checkpoint with every tensor mapped through transform_fn.
+
+    transform_fn(name, value) returns the (name, value) pairs to write in
+    place of the tensor, none to drop it. Works on the raw tensors, so it
+    needs no model graph and also carries over the hash tables and optimizer
+    slots. Returns the new checkpoint path.
+    """
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        names_to_variables, input_feed = {}, {}
+        for name in reader.get_variable_to_shape_map():
+            for new_name, value in transform_fn(name, reader.get_tensor(name)):
+                value = np.asarray(value)
+                dtype = tf.string if value.dtype == object else tf.as_dtype(value.dtype)
+                # fed through a placeholder to keep large tensors out of the graph
+                initial_value = tf.placeholder(dtype, value.shape)
+                input_feed[initial_value] = value
+                names_to_variables[new_name] = tf.Variable(initial_value, trainable=False)
+        sess.run(tf.global_variables_initializer(), input_feed)
+        saver = tf.train.Saver(names_to_variables, write_version=tf.train.SaverDef.V2, pad_step_number=True)
+        return saver.save(sess, save_path, global_step=global_step, write_meta_graph=False)
+
+def rename_checkpoint(checkpoint_path, save_path, rename_fn, global_step=None):
+    """Writes a copy of a checkpoint with every tensor name mapped through rename_fn."""
+    return transform_checkpoint(checkpoint_path, save_path,
+            lambda name, value: [(rename_fn(name), value)], global_step)
@@ -0,0 +1,37 @@
+import numpy as np
+
+class DecodeLengthPolicy(object):
+    """Caps the number of decoding steps from the length of the post.
+
+    Posts are bucketed by length and every bucket is capped at a quantile of
+    the response lengths observed for its posts, plus a margin. Buckets with
+    too few observations fall back to the quantile over all responses, and no
+    cap exceeds the model's max_length.
+
+    mode 'example' gives every post its own cap, 'batch' caps the whole batch
+    at the largest cap of its posts. The decoding loop only stops once every
+    row is done, so both bound the latency of a batch the same way; 'example'
+    additionally truncates long responses to short posts.
+    """
+    def __init__(self, pairs, max_length=60, mode='batch', quantile=0.99, margin=2,
+            bucket_width=5, min_count=50):
+        self.max_length = max_length
+        self.mode = mode
+        self.bucket_width = bucket_width
+        buckets = {}
+        for post_len, response_len in pairs:
+            buckets.setdefault(post_len // bucket_width, []).append(response_len)
+        lengths = [x for bucket in buckets.values() for x in bucket]
+        self.default_cap = self._cap(lengths, quantile, margin)
+        self.caps = dict([(bucket, self._cap(x, quantile, margin))
+                for bucket, x in buckets.items() if len(x) >= min_count])
+
+    def _cap(self, lengths, quantile, margin):
+        return min(self.max_length, int(np.ceil(np.percentile(lengths, quantile * 100))) + margin)
+
+    def __call__(self, data):
+        caps = np.array([self.caps.get(len(item['post']) // self.bucket_width, self.default_cap)
+                for item in data], dtype=np.int32)
+        if self.mode == 'batch':
+            caps[:] = np.max(caps)
+        return caps
@@ -0,0 +1,21 @@
+import tensorflow as tf
+
+class Teacher(object):
+    """A trained model in a graph and session of its own, for distilling a student.
+
+    build_fn builds the teacher Model with teacher_top_k set; soft_targets
+    runs it on a batch of the student and returns what the student's
+    step_decoder takes as soft_targets.
+    """
+    def __init__(self, build_fn, model_path, config=None):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.model = build_fn()
+            self.sess = tf.Session(graph=self.graph, config=config)
+            self.model.saver.restore(self.sess, model_path)
+
+    def soft_targets(self, batched_data):
+        return self.model.step_teacher(self.sess, batched_data)
+
+    def close(self):
+        self.sess.close()
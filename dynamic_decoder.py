@@ -65,14 +65,10 @@ def dynamic_rnn_decoder(cell, decoder_fn, inputs=None, sequence_length=None,
                 if cell_state is None:
                     next_cell_input = inputs_ta.read(0)
                 else:
-                    if batch_depth is not None:
-                        batch_size = batch_depth
-                    else:
-                        batch_size = array_ops.shape(done)[0]
-                    next_cell_input = control_flow_ops.cond(
-                            math_ops.equal(time, max_time),
-                            lambda: array_ops.zeros([batch_size, input_depth], dtype=dtype),
-                            lambda: inputs_ta.read(time))
+                    # zeros past the last input, selected element-wise rather
+                    # than with a per-step cond so the loop body can be fused
+                    next_cell_input = inputs_ta.read(math_ops.minimum(time, max_time - 1)) * \
+                            math_ops.cast(math_ops.less(time, max_time), dtype)
                 (next_done, next_cell_state, next_cell_input, emit_output,
                  next_context_state) = decoder_fn(time, cell_state, next_cell_input,
                                                                                     cell_output, context_state)
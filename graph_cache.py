@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import time
+
+import tensorflow as tf
+
+# the modules that build the graph of a Model, a change to any of them
+# invalidates the cached graphs
+MODEL_SOURCES = ['model.py', 'attention_decoder.py', 'dynamic_decoder.py', 'output_projection.py', 'quantization.py']
+
+def code_version():
+    digest = hashlib.sha1(tf.__version__.encode('utf-8'))
+    for source in MODEL_SOURCES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), source), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def graph_key(args, kwargs):
+    # the Model arguments must be JSON values, arrays such as pretrained
+    # embeddings would end up in the graph and are refused here
+    options = json.dumps([list(args), kwargs], sort_keys=True)
+    return hashlib.sha1((options + code_version()).encode('utf-8')).hexdigest()
+
+def _bindings(model):
+    # how to find every attribute of model again in an imported graph
+    bindings = {}
+    for attr, value in vars(model).items():
+        if isinstance(value, tf.Variable):
+            bindings[attr] = ['variable', value.op.name]
+        elif isinstance(value, tf.Tensor):
+            bindings[attr] = ['tensor', value.name]
+        elif isinstance(value, tf.Operation):
+            bindings[attr] = ['operation', value.name]
+        elif isinstance(value, list) and all(isinstance(x, tf.Variable) for x in value):
+            bindings[attr] = ['variables', [x.op.name for x in value]]
+        elif isinstance(value, list) and all(isinstance(x, tf.Tensor) for x in value):
+            bindings[attr] = ['tensors', [x.name for x in value]]
+        elif value is None or isinstance(value, (bool, int, float, str)):
+            bindings[attr] = ['value', value]
+    return bindings
+
+def export_model(model, path):
+    # written aside and renamed, so other processes never see half a graph
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    tf.train.export_meta_graph('%s.meta' % tmp_path, saver_def=model.saver.saver_def, clear_devices=True)
+    with open('%s.json' % tmp_path, 'w') as f:
+        f.write(json.dumps(_bindings(model)) + '\n')
+    os.rename('%s.meta' % tmp_path, '%s.meta' % path)
+    os.rename('%s.json' % tmp_path, '%s.json' % path)
+
+def import_model(model_class, path):
+    """A model_class instance bound to the graph exported at path.
+
+    The graph is imported into the default graph, which should be empty,
+    and the attributes of the exported model are bound to its tensors,
+    operations and variables by name, so the step methods of model_class
+    work unchanged. saver is the saver of the export; attributes that are
+    neither (hash tables, other savers) are not available.
+    """
+    with open('%s.json' % path) as f:
+        bindings = json.loads(f.readline())
+    saver = tf.train.import_meta_graph('%s.meta' % path, clear_devices=True)
+    graph = tf.get_default_graph()
+    variables = dict([(v.op.name, v) for v in tf.global_variables() + tf.local_variables()])
+    model = model_class.__new__(model_class)
+    for attr, (kind, value) in bindings.items():
+        if kind == 'variable':
+            value = variables[value]
+        elif kind == 'tensor':
+            value = graph.get_tensor_by_name(value)
+        elif kind == 'operation':
+            value = graph.get_operation_by_name(value)
+        elif kind == 'variables':
+            value = [variables[name] for name in value]
+        elif kind == 'tensors':
+            value = [graph.get_tensor_by_name(name) for name in value]
+        setattr(model, attr, value)
+    model.saver = saver
+    return model
+
+def load_or_build(cache_dir, model_class, args, kwargs):
+    """model_class(*args, **kwargs), imported if a graph was exported for the same arguments and code."""
+    start_time = time.time()
+    path = '%s/%s' % (cache_dir, graph_key(args, kwargs))
+    if os.path.exists('%s.json' % path):
+        model = import_model(model_class, path)
+        print('imported graph %s in %.2fs' % (path, time.time() - start_time))
+        return model
+    model = model_class(*args, **kwargs)
+    build_time = time.time() - start_time
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    export_model(model, path)
+    print('built graph in %.2fs, exported to %s' % (build_time, path))
+    return model
@@ -0,0 +1,235 @@
+import collections
+import threading
+import time
+
+import numpy as np
+
+from memory_model import batch_dims
+
+def normalize_post(post):
+    # posts differing only in case and punctuation share a response
+    return tuple([word.lower() for word in post if any(c.isalnum() for c in word)])
+
+def subgraph_key(item):
+    return tuple([tuple(triple) for triple in item['all_triples']])
+
+def trim_response(response):
+    # the tokens of a generation before its first _EOS
+    result = []
+    for token in response:
+        if token == '_EOS':
+            break
+        result.append(token)
+    return result
+
+def subgraph_ids(item, triple_num):
+    # the subgraphs of a row of gen_batched_data: the placeholder subgraph,
+    # those of the item, then padding
+    ids = [('_NAF', )] + [tuple(triple) for triple in item['all_triples']]
+    return ids + [()] * (triple_num - len(ids))
+
+class LRUCache(object):
+    """Thread-safe LRU map bounded by the total size_fn of its values."""
+    def __init__(self, capacity, size_fn=lambda value: 1):
+        self.capacity = capacity
+        self.size_fn = size_fn
+        self.size = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        size = self.size_fn(value)
+        if size > self.capacity:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= self.size_fn(self._entries.pop(key))
+            self._entries[key] = value
+            self.size += size
+            while self.size > self.capacity:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= self.size_fn(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def hit_rate(self):
+        return self.hits / float(max(self.hits + self.misses, 1))
+
+
+class CachedGenerator(object):
+    """Greedy generation behind a response cache and an encoder cache.
+
+    Responses are cached per (checkpoint, normalized post, subgraph ids,
+    decode settings, padded dims of the batch, decode feeds). Misses are
+    decoded as one batch at the dims and with the feeds of the whole batch,
+    and their encoder side (the encoder state and the attention keys and
+    values of the post and its memories) is cached per example and fed to
+    the decoder in place of the encoder. Padding is not masked in the
+    attention, so these depend on the padded dims of the batch and are
+    reused only at the same dims; missing rows are encoded padded to them.
+    A response is thus that of decoding the batch at once, except that
+    posts differing only in case and punctuation share it. Restoring a
+    checkpoint clears both.
+
+    Rows that are encoded take the graph vectors and the graph and triple
+    keys and values of their subgraphs from a cache per subgraph, since the
+    same subgraphs recur across posts. The padding of the triples enters
+    the graph attention, so entries are reused at the same triple_len only.
+
+    batch_fn(data, dims) builds the batch, feed_fn(data) returns extra feeds
+    such as decoding caps, described by settings in the response key. The
+    feeds named in ROW_FEEDS have a row per example and enter its key by
+    that row, the others belong to the batch and enter the key whole.
+    """
+    ROW_FEEDS = ['max_dec_lens:0']
+
+    def __init__(self, model, sess, batch_fn, checkpoint, response_cache_size=10000,
+            encoder_cache_bytes=512 * 2**20, feed_fn=None, settings=(), subgraph_cache_bytes=0):
+        self.model = model
+        self.sess = sess
+        self.batch_fn = batch_fn
+        self.feed_fn = feed_fn
+        self.settings = settings
+        self.checkpoint = checkpoint
+        self.responses = LRUCache(response_cache_size)
+        self.encoder_rows = LRUCache(encoder_cache_bytes, size_fn=lambda row: sum([x.nbytes for x in row]))
+        self.subgraphs = LRUCache(subgraph_cache_bytes, size_fn=lambda entry: sum([x.nbytes for x in entry])) if subgraph_cache_bytes > 0 else None
+        self.subgraphs_computed = 0
+        self.latency = collections.defaultdict(lambda: [0, .0])
+
+    def restore(self, saver, checkpoint):
+        saver.restore(self.sess, checkpoint)
+        self.checkpoint = checkpoint
+        self.responses.clear()
+        self.encoder_rows.clear()
+        if self.subgraphs is not None:
+            self.subgraphs.clear()
+
+    def _timed(self, name, start_time):
+        self.latency[name][0] += 1
+        self.latency[name][1] += time.time() - start_time
+
+    def _input_feed(self, data, dims):
+        batched_data = self.batch_fn(data, dims)
+        return {self.model.posts: batched_data['posts'],
+                self.model.posts_length: batched_data['posts_length'],
+                self.model.triples: batched_data['triples'],
+                self.model.posts_triple: batched_data['posts_triple'],
+                self.model.entities: batched_data['entities']}
+
+    def _feed_subgraphs(self, input_feed, data, dims):
+        # feeds the subgraph side of the batch from the subgraph cache; the
+        # missing subgraphs are computed first, each as a batch row of its own
+        model = self.model
+        keys = [[(self.checkpoint, dims['triple_len'], ids) for ids in subgraph_ids(item, dims['triple_num'])] for item in data]
+        entries, missing = {}, []
+        for i, row in enumerate(keys):
+            for j, key in enumerate(row):
+                if key not in entries:
+                    entries[key] = self.subgraphs.get(key)
+                    if entries[key] is None:
+                        missing.append((key, i, j))
+        if missing:
+            start_time = time.time()
+            triples = input_feed[model.triples]
+            outputs = self.sess.run(model.subgraph_tensors, {model.posts: np.array([['_EOS']] * len(missing)),
+                model.triples: np.stack([triples[i, j:j+1] for _, i, j in missing])})
+            for k, (key, _, _) in enumerate(missing):
+                entries[key] = [x[k, 0] for x in outputs]
+                self.subgraphs.put(key, entries[key])
+            self._timed('subgraphs', start_time)
+            self.subgraphs_computed += len(missing)
+        for k, tensor in enumerate(model.subgraph_tensors):
+            input_feed[tensor] = np.array([[entries[key][k] for key in row] for row in keys])
+        return input_feed
+
+    def _feed_key(self, feed, i):
+        return tuple([(name, int(value[i]) if name in self.ROW_FEEDS else np.asarray(value).tobytes())
+            for name, value in sorted(feed.items())])
+
+    def generate(self, data):
+        start_time = time.time()
+        dims = batch_dims(data)
+        dims_key = (dims['encoder_len'], dims['triple_num'], dims['triple_len'])
+        feed = self.feed_fn(data) if self.feed_fn is not None else {}
+        keys = [(self.checkpoint, normalize_post(item['post']), subgraph_key(item), self.settings, dims_key, self._feed_key(feed, i))
+            for i, item in enumerate(data)]
+        results = [self.responses.get(key) for key in keys]
+        misses = [i for i, result in enumerate(results) if result is None]
+        if misses:
+            # the rows of the misses in the feeds of the row, the others as they are
+            missing_feed = dict([(name, np.asarray(value)[misses] if name in self.ROW_FEEDS else value)
+                for name, value in feed.items()])
+            for i, result in zip(misses, self._decode([data[i] for i in misses], dims, missing_feed)):
+                results[i] = result
+                self.responses.put(keys[i], result)
+        self._timed('generate', start_time)
+        return results
+
+    def _decode(self, data, dims, feed):
+        model = self.model
+        dims_key = (dims['encoder_len'], dims['triple_num'], dims['triple_len'])
+        keys = [(self.checkpoint, tuple(item['post']), subgraph_key(item), tuple(item['post_triples']), dims_key) for item in data]
+        rows = [self.encoder_rows.get(key) for key in keys]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        input_feed = self._input_feed(data, dims)
+        input_feed.update(feed)
+
+        start_time = time.time()
+        if len(missing) == len(data):
+            # nothing cached, encode and decode in one run
+            if self.subgraphs is not None:
+                input_feed = self._feed_subgraphs(input_feed, data, dims)
+            outputs = self.sess.run([model.generation] + model.encoder_cache_tensors, input_feed)
+            generation, encoded = outputs[0], outputs[1:]
+        else:
+            generation = None
+            if missing:
+                missing_start_time = time.time()
+                missing_feed = self._input_feed([data[i] for i in missing], dims)
+                if self.subgraphs is not None:
+                    missing_feed = self._feed_subgraphs(missing_feed, [data[i] for i in missing], dims)
+                encoded = self.sess.run(model.encoder_cache_tensors, missing_feed)
+                self._timed('encode', missing_start_time)
+        for j, i in enumerate(missing):
+            rows[i] = [x[j] for x in encoded]
+            self.encoder_rows.put(keys[i], rows[i])
+        if generation is None:
+            for k, tensor in enumerate(model.encoder_cache_tensors):
+                input_feed[tensor] = np.stack([row[k] for row in rows])
+            generation = self.sess.run(model.generation, input_feed)
+        self._timed('decode', start_time)
+
+        return [trim_response(response) for response in generation]
+
+    def metrics(self):
+        metrics = {'response_hit_rate': self.responses.hit_rate(),
+                'response_evictions': self.responses.evictions,
+                'encoder_hit_rate': self.encoder_rows.hit_rate(),
+                'encoder_evictions': self.encoder_rows.evictions,
+                'encoder_cache_mb': self.encoder_rows.size / float(2**20)}
+        if self.subgraphs is not None:
+            # a hit saves what computing a missing subgraph took on average
+            count, total = self.latency['subgraphs']
+            metrics.update({'subgraph_hit_rate': self.subgraphs.hit_rate(),
+                'subgraph_evictions': self.subgraphs.evictions,
+                'subgraph_cache_mb': self.subgraphs.size / float(2**20),
+                'subgraph_saved_ms': self.subgraphs.hits * total / max(self.subgraphs_computed, 1) * 1000})
+        for name, (count, total) in self.latency.items():
+            metrics['%s_ms' % name] = total / max(count, 1) * 1000
+        return metrics
@@ -0,0 +1,61 @@
+import re
+
+import numpy as np
+
+_TOKEN_RE = re.compile(r"[\w']+|[^\w\s]", re.UNICODE)
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text.lower())
+
+class EntityTripleIndex(object):
+    """Inverted index from entity to the knowledge triples it is head or tail of.
+
+    The triples of an entity are a contiguous slice of two int32 arrays, the
+    triple ids and the entity at the other end of each triple, with offsets
+    per entity id (CSR), so looking up a token costs a dict lookup in the
+    entity table and a slice. retrieve turns the tokens of a raw post into the subgraph fields
+    the dataset precomputes: all_triples, all_entities and post_triples.
+    """
+    def __init__(self, kb, stopwords=(), max_subgraphs=20, max_subgraph_size=50):
+        self.entities = kb.entities
+        self.stopwords = set(stopwords)
+        self.max_subgraphs = max_subgraphs
+        self.max_subgraph_size = max_subgraph_size
+        heads, tails = kb.triples[:, 0], kb.triples[:, 2]
+        triple_ids = np.arange(len(kb.triples), dtype=np.int32)
+        keys = np.concatenate([heads, tails])
+        order = np.argsort(keys, kind='mergesort')    # stable, triples keep their order
+        self.triples = np.concatenate([triple_ids, triple_ids])[order]
+        self.neighbors = np.concatenate([tails, heads])[order]
+        self.offsets = np.searchsorted(keys[order], np.arange(len(kb.entities) + 1)).astype(np.int64)
+
+    def lookup(self, entity):
+        # triple ids and neighbouring entity ids of an entity, empty if unknown
+        i = self.entities.index(entity)
+        if i < 0:
+            return self.triples[:0], self.neighbors[:0]
+        start, end = self.offsets[i], self.offsets[i+1]
+        end = min(end, start + self.max_subgraph_size)
+        return self.triples[start:end], self.neighbors[start:end]
+
+    def retrieve(self, tokens):
+        # one subgraph per distinct matched token, numbered from 1 in
+        # post_triples, 0 marks a token without one
+        all_triples, all_entities, post_triples = [], [], []
+        subgraphs = {}
+        for token in tokens:
+            if token not in subgraphs and token not in self.stopwords and len(all_triples) < self.max_subgraphs:
+                triples, neighbors = self.lookup(token)
+                if len(triples):
+                    all_triples.append(triples.tolist())
+                    all_entities.append(neighbors.tolist())
+                    subgraphs[token] = len(all_triples)
+            post_triples.append(subgraphs.get(token, 0))
+        return {'all_triples': all_triples, 'all_entities': all_entities, 'post_triples': post_triples}
+
+    def raw_item(self, text):
+        # a dataset item for a raw post, without a reference response
+        item = {'post': tokenize(text), 'response': [], 'response_triples': [],
+                'match_index': [], 'match_triples': []}
+        item.update(self.retrieve(item['post']))
+        return item
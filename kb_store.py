@@ -0,0 +1,157 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+class StringTable(object):
+    """Interned strings in one utf-8 buffer, string i is data[offsets[i]:offsets[i+1]].
+
+    order sorts the strings, index finds a string by binary search over it,
+    so a table needs no Python dict and can stay memory-mapped. Tables read
+    per triple are decoded once instead, see DecodedTable.
+    """
+    def __init__(self, data, offsets, order):
+        self.data = data
+        self.offsets = offsets
+        self.order = order
+
+    @staticmethod
+    def build(strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(s) for s in encoded])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8) if encoded else np.zeros(0, dtype=np.uint8)
+        order = np.array(sorted(range(len(encoded)), key=lambda i: encoded[i]), dtype=np.int32)
+        return data, offsets, order
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _bytes(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]].tobytes()
+
+    def __getitem__(self, i):
+        return self._bytes(i).decode('utf-8')
+
+    def index(self, s):
+        # id of s, -1 if it is not in the table
+        key, lo, hi = s.encode('utf-8'), 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._bytes(self.order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.order) and self._bytes(self.order[lo]) == key:
+            return int(self.order[lo])
+        return -1
+
+
+class DecodedTable(list):
+    """The strings of a StringTable decoded into a list, with a dict for index.
+
+    For the entities and relations, which the batching reads for every
+    triple: one decode at load instead of one per lookup.
+    """
+    def __init__(self, table):
+        data, offsets = table.data.tobytes(), table.offsets.tolist()
+        super(DecodedTable, self).__init__(data[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(len(table)))
+        self.ids = dict((s, i) for i, s in enumerate(self))
+
+    def index(self, s):
+        # id of s, -1 if it is not in the table
+        return self.ids.get(s, -1)
+
+
+class KBStore(object):
+    """The knowledge base and vocabulary of resource.txt as memory-mapped arrays.
+
+    triples is an int32 [N, 3] array of (head, relation, tail), heads and
+    tails indexing entities and relations indexing relations, both string
+    tables. Triple ids and the ids of the first len(csk_entities) entities
+    are those of resource.txt, so the ids in the dataset still apply.
+    dict_csk is kept as a CSR adjacency from entity id to triple ids and the
+    vocabulary as its words sorted by frequency. The entity and relation
+    tables are decoded at load, the arrays and the vocabulary stay mapped.
+    """
+    TABLES = ['entities', 'relations', 'vocab']
+    DECODED = ['entities', 'relations']
+    ARRAYS = ['triples', 'csk_offsets', 'csk_triples', 'vocab_counts']
+
+    def __init__(self, path):
+        load = lambda name: np.load('%s/%s.npy' % (path, name), mmap_mode='r')
+        for name in self.ARRAYS:
+            setattr(self, name, load(name))
+        for name in self.TABLES:
+            table = StringTable(load('%s_data' % name), load('%s_offsets' % name), load('%s_order' % name))
+            setattr(self, name, DecodedTable(table) if name in self.DECODED else table)
+
+    @classmethod
+    def open(cls, data_dir):
+        # built from resource.txt on first use
+        path = '%s/kb' % data_dir
+        if not os.path.exists(path):
+            cls.build('%s/resource.txt' % data_dir, path)
+        return cls(path)
+
+    @classmethod
+    def build(cls, resource_path, path):
+        with open(resource_path) as f:
+            d = json.loads(f.readline())
+        entities = list(d['csk_entities'])
+        entity_ids = dict([(entity, i) for i, entity in enumerate(entities)])
+        relations, relation_ids = [], {}
+        triples = np.zeros((len(d['csk_triples']), 3), dtype=np.int32)
+        for i, triple in enumerate(d['csk_triples']):
+            head, relation, tail = triple.split(', ')
+            for entity in [head, tail]:
+                if entity not in entity_ids:
+                    # triples may name entities csk_entities leaves out
+                    entity_ids[entity] = len(entities)
+                    entities.append(entity)
+            if relation not in relation_ids:
+                relation_ids[relation] = len(relations)
+                relations.append(relation)
+            triples[i] = [entity_ids[head], relation_ids[relation], entity_ids[tail]]
+
+        triple_ids = dict([(triple, i) for i, triple in enumerate(d['csk_triples'])])
+        adjacency = [[] for _ in entities]
+        for entity, entity_triples in d['dict_csk'].items():
+            if entity in entity_ids:
+                adjacency[entity_ids[entity]] = [x if isinstance(x, int) else triple_ids[x] for x in entity_triples]
+        csk_offsets = np.zeros(len(entities) + 1, dtype=np.int64)
+        csk_offsets[1:] = np.cumsum([len(x) for x in adjacency])
+        csk_triples = np.array([x for entity_triples in adjacency for x in entity_triples], dtype=np.int32)
+
+        vocab = sorted(d['vocab_dict'], key=d['vocab_dict'].get, reverse=True)
+        vocab_counts = np.array([d['vocab_dict'][word] for word in vocab], dtype=np.int64)
+
+        # written aside and renamed, so other processes never see half a store
+        tmp_path = '%s.tmp%d' % (path, os.getpid())
+        os.makedirs(tmp_path)
+        arrays = {'triples': triples, 'csk_offsets': csk_offsets, 'csk_triples': csk_triples, 'vocab_counts': vocab_counts}
+        for name, strings in [('entities', entities), ('relations', relations), ('vocab', vocab)]:
+            arrays['%s_data' % name], arrays['%s_offsets' % name], arrays['%s_order' % name] = StringTable.build(strings)
+        for name, array in arrays.items():
+            np.save('%s/%s.npy' % (tmp_path, name), array)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # built by another process in the meantime
+            shutil.rmtree(tmp_path)
+
+    def triple(self, i):
+        head, relation, tail = self.triples[i].tolist()
+        return [self.entities[head], self.relations[relation], self.entities[tail]]
+
+    def triple_string(self, i):
+        # the triple as resource.txt spells it
+        return ', '.join(self.triple(i))
+
+    def entity_triples(self, entity):
+        # dict_csk[entity] as triple ids
+        i = self.entities.index(entity)
+        if i < 0:
+            return self.csk_triples[:0]
+        return self.csk_triples[self.csk_offsets[i]:self.csk_offsets[i+1]]
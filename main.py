@@ -5,10 +5,23 @@ from tensorflow.python.framework import constant_op
 import sys
 import math
 import os
+import re
 import time
 import random
+import threading
 random.seed(time.time())
-from model import Model, _START_VOCAB
+from model import Model, _START_VOCAB, block_cell_variable_name
+from checkpoints import CheckpointIndex, AsyncSaver, rename_checkpoint, transform_checkpoint
+from decode_length import DecodeLengthPolicy
+from distillation import Teacher
+from graph_cache import load_or_build
+from kb_index import EntityTripleIndex
+from kb_store import KBStore
+from inference_cache import CachedGenerator, trim_response
+from streaming import StreamingDecoder
+from memory_model import MemoryCostModel, batch_dims, measure_bytes, memory_report, parse_dims, profile_step, synthetic_batch
+from quantization import quantize_variable
+from session_config import load_session_settings, save_session_settings, session_config, candidate_settings, time_sessions
 
 tf.app.flags.DEFINE_boolean("is_train", True, "Set to False to inference.")
 tf.app.flags.DEFINE_integer("symbols", 30000, "vocabulary size.")
@@ -25,21 +38,107 @@ tf.app.flags.DEFINE_integer("per_checkpoint", 1000, "How many steps to do per ch
 tf.app.flags.DEFINE_integer("inference_version", 0, "The version for inferencing.")
 tf.app.flags.DEFINE_boolean("log_parameters", True, "Set to True to show the parameters")
 tf.app.flags.DEFINE_string("inference_path", "test", "Set filename of inference")
+tf.app.flags.DEFINE_boolean("inline_eval", True, "Set to False to leave dev evaluation to the evaluator.")
+tf.app.flags.DEFINE_boolean("is_evaluator", False, "Set to True to evaluate new checkpoints in train_dir continuously.")
+tf.app.flags.DEFINE_integer("eval_shards", 0, "Number of dev set shards the evaluator runs in parallel, 0 for the tuned number of sessions or 4.")
+tf.app.flags.DEFINE_integer("eval_threads", 0, "Intra-op threads of the evaluator session, 0 for the default.")
+tf.app.flags.DEFINE_integer("eval_interval", 60, "Seconds the evaluator waits between checks for new checkpoints.")
+tf.app.flags.DEFINE_string("score_path", "", "Set filename of posts with candidate responses to score.")
+tf.app.flags.DEFINE_integer("num_responses", 0, "Number of responses sampled per post at inference, 0 for greedy decoding.")
+tf.app.flags.DEFINE_float("temperature", 1.0, "Softmax temperature of sampled decoding.")
+tf.app.flags.DEFINE_integer("top_k", 0, "Sample from the k most likely words and entities, 0 for all.")
+tf.app.flags.DEFINE_float("top_p", 1.0, "Sample from the smallest set of words and entities holding this probability mass.")
+tf.app.flags.DEFINE_boolean("sample_benchmark", False, "Set to True to time sampling against independent runs per response.")
+tf.app.flags.DEFINE_string("decode_length_policy", "fixed", "Cap on decoding steps: fixed, batch or example.")
+tf.app.flags.DEFINE_float("decode_length_quantile", 0.99, "Quantile of the dev response lengths the decoding cap covers.")
+tf.app.flags.DEFINE_integer("decode_length_margin", 2, "Steps added to the decoding cap.")
+tf.app.flags.DEFINE_boolean("use_jit", False, "Set to True to compile the encoder, attention, decoder and loss with XLA. Experimental and not yet measured, compare the step times with benchmark.py --compare=use_jit=False,True before enabling it.")
+tf.app.flags.DEFINE_boolean("use_lstm", False, "Set to True to use LSTM instead of GRU cells.")
+tf.app.flags.DEFINE_boolean("block_cells", False, "Set to True to use the fused GRUBlockCell/LSTMBlockCell kernels.")
+tf.app.flags.DEFINE_integer("grad_accum_steps", 1, "Number of batches whose gradients are accumulated into one update.")
+tf.app.flags.DEFINE_boolean("clip_micro_batches", False, "Set to True to clip the gradients of every accumulated batch instead of their mean.")
+tf.app.flags.DEFINE_boolean("recompute_attention", False, "Set to True to recompute the decoder attention in the backward pass instead of keeping it, trading training time for memory.")
+tf.app.flags.DEFINE_boolean("swap_memory", False, "Set to True to swap the activations of the encoder and decoder loops from GPU to host memory during training.")
+tf.app.flags.DEFINE_string("memory_dtype", "float32", "Storage type of the knowledge embeddings and of the attention memories of the encoder, graphs and triples: float32 or float16.")
+tf.app.flags.DEFINE_boolean("compare_memory_dtype", False, "Set to True to compare the perplexity, match entity rate and latency of the inference checkpoint with float32 memories and with memory_dtype on the test set.")
+tf.app.flags.DEFINE_integer("memory_budget", 0, "Memory in MB a step may take, larger batches are split. 0 to never split.")
+tf.app.flags.DEFINE_string("memory_profile", "", "Comma-separated batch dims to profile memory at, e.g. 50x20x20x10x30,100x20x20x10x30 for batch x encoder_len x decoder_len x triple_num x triple_len; the training steps if is_train, else the test steps. Writes a report and fits the memory model.")
+tf.app.flags.DEFINE_boolean("autotune", False, "Set to True to tune the session threads for training, evaluation and inference on this host.")
+tf.app.flags.DEFINE_integer("autotune_batches", 5, "Dev batches timed per autotuned setting.")
+tf.app.flags.DEFINE_integer("shortlist_size", 0, "Most frequent words the greedy decoder scores along with the words of the posts and their entities, 0 for the full vocabulary.")
+tf.app.flags.DEFINE_float("shortlist_fallback", 0.0, "Rows of a greedy step whose estimated probability of the words outside the shortlist exceeds this are rescored over the full vocabulary, 0 to never rescore.")
+tf.app.flags.DEFINE_string("raw_path", "", "Set to a file of raw posts, one per line, to answer through the response and encoder caches; subgraphs are retrieved from the knowledge base.")
+tf.app.flags.DEFINE_boolean("raw_test", False, "Set with raw_path to decode the raw posts through test() over the checkpoints, like the test set, instead of the caches.")
+tf.app.flags.DEFINE_integer("max_subgraphs", 20, "Subgraphs retrieved per raw post at most.")
+tf.app.flags.DEFINE_integer("max_subgraph_size", 50, "Triples per retrieved subgraph at most.")
+tf.app.flags.DEFINE_integer("response_cache_size", 10000, "Responses to raw posts kept in the LRU response cache, 0 to disable.")
+tf.app.flags.DEFINE_integer("encoder_cache_mb", 512, "Memory in MB of encoder outputs and memory keys kept for raw posts, 0 to disable.")
+tf.app.flags.DEFINE_integer("subgraph_cache_mb", 256, "Memory in MB of graph vectors and memory keys kept per knowledge subgraph for raw posts, 0 to disable.")
+tf.app.flags.DEFINE_boolean("stream", False, "Set to True to decode the raw posts step by step, printing every token as it is chosen.")
+tf.app.flags.DEFINE_boolean("quantize", False, "Set to True to write an int8 copy of the checkpoint to train_dir/quantized and compare it with the float model on the test set.")
+tf.app.flags.DEFINE_boolean("quantized", False, "Set to True to run inference from a checkpoint written by --quantize.")
+tf.app.flags.DEFINE_string("distill_from", "", "Set to the train_dir of a trained teacher to distill it into the model of train_dir, or with is_train=False to compare the two on the test set.")
+tf.app.flags.DEFINE_integer("teacher_units", 512, "Size of each layer of the teacher.")
+tf.app.flags.DEFINE_integer("teacher_layers", 2, "Number of layers of the teacher.")
+tf.app.flags.DEFINE_integer("teacher_trans_units", 100, "Size of trans embedding of the teacher.")
+tf.app.flags.DEFINE_boolean("teacher_use_lstm", False, "Set to True if the teacher uses LSTM instead of GRU cells.")
+tf.app.flags.DEFINE_boolean("teacher_block_cells", False, "Set to True if the teacher uses the fused block cells.")
+tf.app.flags.DEFINE_string("teacher_softmax_cutoffs", "", "Vocabulary cutoffs of the adaptive softmax of the teacher, empty for the flat softmax.")
+tf.app.flags.DEFINE_string("teacher_memory_dtype", "float32", "Storage type of the memories of the teacher: float32 or float16.")
+tf.app.flags.DEFINE_boolean("teacher_use_jit", False, "Set to True to compile the teacher with XLA.")
+tf.app.flags.DEFINE_integer("distill_top_k", 100, "Words of the teacher's word distribution kept as soft targets.")
+tf.app.flags.DEFINE_float("distill_weight", 0.5, "Weight of the loss against the teacher, the rest is on the references.")
+tf.app.flags.DEFINE_integer("transe_units", 100, "Size of the pretrained TransE vectors, trans_units may be smaller.")
+tf.app.flags.DEFINE_string("softmax_cutoffs", "", "Comma-separated vocabulary cutoffs of an adaptive softmax, e.g. 2000,10000: the head scores the words before the first and one cluster per range after it, scored from narrower projections. Empty for the flat softmax.")
+tf.app.flags.DEFINE_string("flat_softmax_from", "", "Set with softmax_cutoffs and is_train=False to the train_dir of a model with the flat softmax, to compare the two on the test set.")
+tf.app.flags.DEFINE_boolean("graph_cache", False, "Set to True to import the graphs of the evaluator, scoring and inference from train_dir/graphs, exported by the first process to build them.")
+tf.app.flags.DEFINE_string("convert_checkpoint", "", "Set to a checkpoint to copy into train_dir with cell variables renamed for --block_cells.")
 
 FLAGS = tf.app.flags.FLAGS
 if FLAGS.train_dir[-1] == '/': FLAGS.train_dir = FLAGS.train_dir[:-1]
-csk_triples, csk_entities, kb_dict = [], [], []
+kb = None
+symbol_ids = {}
+memory_model = None
+teacher = None
+# threads and loop parallelism tuned for this host, see --autotune
+session_mode = 'evaluate' if FLAGS.is_evaluator else 'train' if FLAGS.is_train and not FLAGS.score_path else 'inference'
+session_settings = load_session_settings(FLAGS.train_dir, session_mode)
+
+def model_options():
+    # Model options shared by training, evaluation and inference graphs
+    return {'use_jit': FLAGS.use_jit,
+            'use_lstm': FLAGS.use_lstm,
+            'use_block_cells': FLAGS.block_cells,
+            'memory_dtype': FLAGS.memory_dtype,
+            'num_transe_units': FLAGS.transe_units,
+            'softmax_cutoffs': [int(x) for x in FLAGS.softmax_cutoffs.split(',') if x],
+            'parallel_iterations': session_settings.get('parallel_iterations', 32)}
+
+def teacher_options():
+    # Model options of the teacher of distill_from, which the student's flags
+    # do not describe
+    return dict(model_options(),
+            use_jit=FLAGS.teacher_use_jit,
+            use_lstm=FLAGS.teacher_use_lstm,
+            use_block_cells=FLAGS.teacher_block_cells,
+            memory_dtype=FLAGS.teacher_memory_dtype,
+            softmax_cutoffs=[int(x) for x in FLAGS.teacher_softmax_cutoffs.split(',') if x])
+
+def build_model(*args, **kwargs):
+    # Model(*args, **kwargs), through the graph cache if enabled
+    if FLAGS.graph_cache:
+        return load_or_build('%s/graphs' % FLAGS.train_dir, Model, args, kwargs)
+    start_time = time.time()
+    model = Model(*args, **kwargs)
+    print('built graph in %.2fs' % (time.time() - start_time))
+    return model
 
 def prepare_data(path, is_train=True):
-    global csk_entities, csk_triples, kb_dict
+    global kb
     
-    with open('%s/resource.txt' % path) as f:
-        d = json.loads(f.readline())
-    
-    csk_triples = d['csk_triples']
-    csk_entities = d['csk_entities']
-    raw_vocab = d['vocab_dict']
-    kb_dict = d['dict_csk']
+    # resource.txt, memory-mapped; the vocabulary comes sorted by frequency
+    kb = KBStore.open(path)
+    raw_vocab = kb.vocab
     
     data_train, data_dev, data_test = [], [], []
     
@@ -60,11 +159,14 @@ def prepare_data(path, is_train=True):
 
     return raw_vocab, data_train, data_dev, data_test
 
+def build_vocab_list(raw_vocab):
+    # sorted by frequency, the order of the symbols in the model's tables
+    vocab_list = _START_VOCAB + [raw_vocab[i] for i in range(min(len(raw_vocab), FLAGS.symbols))]
+    return vocab_list[:FLAGS.symbols]
+
 def build_vocab(path, raw_vocab, trans='transE'):
     print("Creating word vocabulary...")
-    vocab_list = _START_VOCAB + sorted(raw_vocab, key=raw_vocab.get, reverse=True)
-    if len(vocab_list) > FLAGS.symbols:
-        vocab_list = vocab_list[:FLAGS.symbols]
+    vocab_list = build_vocab_list(raw_vocab)
 
     print("Creating entity vocabulary...")
     entity_list = ['_NONE', '_PAD_H', '_PAD_R', '_PAD_T', '_NAF_H', '_NAF_R', '_NAF_T']
@@ -120,54 +222,63 @@ def build_vocab(path, raw_vocab, trans='transE'):
 
     return vocab_list, embed, entity_list, entity_embed, relation_list, relation_embed, entity_relation_embed
 
-def gen_batched_data(data):
-    global csk_entities, csk_triples, kb_dict
-    encoder_len = max([len(item['post']) for item in data])+1
-    decoder_len = max([len(item['response']) for item in data])+1
-    triple_num = max([len(item['all_triples']) for item in data])+1
-    triple_len = max([len(tri) for item in data for tri in item['all_triples']])
-    max_length = 20
+NAF = ['_NAF_H', '_NAF_R', '_NAF_T']
+
+def padding(sent, l):
+    return sent + ['_EOS'] + ['_PAD'] * (l-len(sent)-1)
+
+def padding_triple(triple, num, l):
+    newtriple = []
+    triple = [[NAF]] + triple
+    for tri in triple:
+        newtriple.append(tri + [['_PAD_H', '_PAD_R', '_PAD_T']] * (l-len(tri)))
+    pad_triple = [['_PAD_H', '_PAD_R', '_PAD_T']] * l
+    return newtriple + [pad_triple] * (num - len(newtriple))
+
+def pad_post(item, dims):
+    # the post side of a batch row: the post, its length, its subgraphs and
+    # the subgraph of every post word
+    encoder_len, triple_num, triple_len = dims['encoder_len'], dims['triple_num'], dims['triple_len']
+    return (padding(item['post'], encoder_len), len(item['post'])+1,
+            padding_triple([[kb.triple(x) for x in triple] for triple in item['all_triples']], triple_num, triple_len),
+            [[x] for x in item['post_triples']] + [[0]] * (encoder_len - len(item['post_triples'])))
+
+def pad_response(response, response_triples, match_index, dims):
+    # the response side of a batch row: the response, its length, the triple
+    # of every word and the subgraph position it matches per subgraph
+    decoder_len, triple_num = dims['decoder_len'], dims['triple_num']
+    triples = [NAF] + [NAF if x == -1 else kb.triple(x) for x in response_triples] + [NAF] * (decoder_len - 1 - len(response_triples))
+    match_triples = []
+    for x in match_index:
+        _index = [-1] * triple_num
+        if x[0] != -1 or x[1] != -1:
+            _index[x[0]] = x[1]
+        match_triples.append(_index)
+    match_triples += [[-1]*triple_num]*(decoder_len-len(match_triples))
+    return padding(response, decoder_len), len(response)+1, triples, match_triples
+
+def gen_batched_data(data, dims=None):
+    # dims pads the parts of a split batch like the whole batch
+    dims = dims or batch_dims(data)
+    triple_num, triple_len = dims['triple_num'], dims['triple_len']
     posts, responses, posts_length, responses_length = [], [], [], []
-    entities, triples, matches, post_triples, response_triples = [], [], [], [], []
-    match_entities, all_entities = [], []
+    entities, post_triples, response_triples = [], [], []
     match_triples, all_triples = [], []
-    NAF = ['_NAF_H', '_NAF_R', '_NAF_T']
-    
-    def padding(sent, l):
-        return sent + ['_EOS'] + ['_PAD'] * (l-len(sent)-1)
-
-    def padding_triple(triple, num, l):
-        newtriple = []
-        triple = [[NAF]] + triple
-        for tri in triple:
-            newtriple.append(tri + [['_PAD_H', '_PAD_R', '_PAD_T']] * (l-len(tri)))
-        pad_triple = [['_PAD_H', '_PAD_R', '_PAD_T']] * l
-        return newtriple + [pad_triple] * (num - len(newtriple))
 
     for item in data:
-        posts.append(padding(item['post'], encoder_len))
-        responses.append(padding(item['response'], decoder_len))
-        posts_length.append(len(item['post'])+1)
-        responses_length.append(len(item['response'])+1)
-        all_triples.append(padding_triple([[csk_triples[x].split(', ') for x in triple] for triple in item['all_triples']], triple_num, triple_len))
-        post_triples.append([[x] for x in item['post_triples']] + [[0]] * (encoder_len - len(item['post_triples'])))
-        response_triples.append([NAF] + [NAF if x == -1 else csk_triples[x].split(', ') for x in item['response_triples']] + [NAF] * (decoder_len - 1 - len(item['response_triples'])))
-        match_index = []
+        for values, column in zip(pad_post(item, dims), [posts, posts_length, all_triples, post_triples]):
+            column.append(values)
+        for values, column in zip(pad_response(item['response'], item['response_triples'], item['match_index'], dims),
+                [responses, responses_length, response_triples, match_triples]):
+            column.append(values)
         for idx, x in enumerate(item['match_index']):
-            _index = [-1] * triple_num
-            if x[0] == -1 and x[1] == -1:
-                match_index.append(_index)
-            else:
-                _index[x[0]] = x[1]
-                t = all_triples[-1][x[0]][x[1]]
-                assert(t == response_triples[-1][idx+1])
-                match_index.append(_index)
-        match_triples.append(match_index + [[-1]*triple_num]*(decoder_len-len(match_index)))
+            if x[0] != -1 or x[1] != -1:
+                assert(all_triples[-1][x[0]][x[1]] == response_triples[-1][idx+1])
 
         if not FLAGS.is_train:
             entity = [['_NONE']*triple_len]
             for ent in item['all_entities']:
-                entity.append([csk_entities[x] for x in ent] + ['_NONE'] * (triple_len-len(ent)))
+                entity.append([kb.entities[x] for x in ent] + ['_NONE'] * (triple_len-len(ent)))
             entities.append(entity+[['_NONE']*triple_len]*(triple_num-len(entity)))
 
 
@@ -183,34 +294,170 @@ def gen_batched_data(data):
 
     return batched_data
 
+def gen_named_feed(batched_data):
+    # feed of the placeholders by name, for graphs driven without a Model object
+    input_feed = {'enc_inps:0': batched_data['posts'], 'enc_lens:0': batched_data['posts_length'], 'dec_inps:0': batched_data['responses'], 'dec_lens:0': batched_data['responses_length'], 'triples:0': batched_data['triples'], 'match_triples:0': batched_data['match_triples'], 'enc_triples:0': batched_data['posts_triple'], 'dec_triples:0': batched_data['responses_triple']}
+    if not FLAGS.is_train:
+        input_feed['entities:0'] = batched_data['entities']
+    return input_feed
+
+def gen_shortlist(data):
+    # the shortlist_size most frequent words plus the words of the posts
+    # and of the entities in their subgraphs
+    words = set()
+    for item in data:
+        words.update(item['post'])
+        words.update([kb.entities[x] for entity in item['all_entities'] for x in entity])
+    ids = set(range(max(FLAGS.shortlist_size, len(_START_VOCAB))))
+    ids.update([symbol_ids[word] for word in words if word in symbol_ids])
+    return np.array(sorted(ids), dtype=np.int32)
+
+def split_batch(data, mode):
+    if memory_model is None or FLAGS.memory_budget <= 0:
+        return [data]
+    return memory_model.split(data, mode, FLAGS.memory_budget * 2**20)
+
+def calibrate_memory(sess, data, mode, fetches):
+    # measures steps on dev batches of a few sizes, from the shortest, the
+    # longest and random items, and fits the memory of `mode` to them.
+    # Batches stay below batch_size so calibrating cannot hit an outlier.
+    global memory_model
+    if memory_model.has(mode):
+        return
+    print('calibrating memory model for %s' % mode)
+    by_size = sorted(data, key=lambda item: len(item['post']) + len(item['response']) + sum([len(tri) for tri in item['all_triples']]))
+    samples = []
+    for batch_size in [max(FLAGS.batch_size // x, 1) for x in [8, 4, 2]]:
+        for selected_data in [by_size[:batch_size], by_size[-batch_size:], random.sample(data, batch_size)]:
+            batched_data = gen_batched_data(selected_data)
+            input_feed = gen_named_feed(batched_data)
+            if teacher is not None and mode == 'train':
+                input_feed.update(zip(['teacher_word_probs:0', 'teacher_word_ids:0', 'teacher_selector:0', 'teacher_alignments:0'],
+                    teacher.soft_targets(batched_data)))
+            sess.run(fetches, input_feed)
+            samples.append((batch_dims(selected_data), measure_bytes(sess, fetches, input_feed)))
+    memory_model.fit(mode, samples)
+    memory_model.save('%s/memory_model.json' % FLAGS.train_dir)
+
+def annotate_response(item, response):
+    # link the words of a candidate response to the post's subgraphs the way
+    # the dataset does: a word matches the first triple it is the neighbour
+    # entity of, the entity the decoder copies for that triple
+    entity_triples = {}
+    for i, (triple, entities) in enumerate(zip(item['all_triples'], item['all_entities'])):
+        for j, (x, entity) in enumerate(zip(triple, entities)):
+            entity_triples.setdefault(kb.entities[entity], (x, [i+1, j]))
+    response_triples, match_index = [], []
+    for word in response:
+        x, index = entity_triples.get(word, (-1, [-1, -1]))
+        response_triples.append(x)
+        match_index.append(index)
+    return response_triples, match_index
+
+def gen_scoring_data(data):
+    # padded like gen_batched_data, with every candidate as a response
+    dims = batch_dims([dict(item, response=response) for item in data for response in item['candidates']])
+    posts, responses, posts_length, responses_length, responses_post = [], [], [], [], []
+    post_triples, response_triples, match_triples, all_triples = [], [], [], []
+
+    for post_idx, item in enumerate(data):
+        for values, column in zip(pad_post(item, dims), [posts, posts_length, all_triples, post_triples]):
+            column.append(values)
+        for response in item['candidates']:
+            triples, match_index = annotate_response(item, response)
+            for values, column in zip(pad_response(response, triples, match_index, dims),
+                    [responses, responses_length, response_triples, match_triples]):
+                column.append(values)
+            responses_post.append(post_idx)
+
+    batched_data = {'posts': np.array(posts),
+            'responses': np.array(responses),
+            'posts_length': posts_length,
+            'responses_length': responses_length,
+            'responses_post': responses_post,
+            'triples': np.array(all_triples),
+            'posts_triple': np.array(post_triples),
+            'responses_triple': np.array(response_triples),
+            'match_triples': np.array(match_triples)}
+
+    return batched_data
+
+def soft_targets(batched_data):
+    # the teacher's targets for a batch when distilling
+    return teacher.soft_targets(batched_data) if teacher is not None else None
+
 def train(model, sess, data_train):
-    batched_data = gen_batched_data(data_train)
-    outputs = model.step_decoder(sess, batched_data)
-    return np.sum(outputs[0])
+    parts = split_batch(data_train, 'train')
+    if len(parts) == 1:
+        batched_data = gen_batched_data(data_train)
+        outputs = model.step_decoder(sess, batched_data, soft_targets=soft_targets(batched_data))
+        # the gradient norm is None for batches that are only accumulated
+        return np.sum(outputs[0]), outputs[1]
+    # the loss is a mean over the response tokens of the batch, so each part
+    # contributes its gradient weighted by its share of the tokens
+    dims = batch_dims(data_train)
+    num_tokens = float(sum([len(item['response'])+1 for item in data_train]))
+    loss = .0
+    for idx, part in enumerate(parts):
+        weight = sum([len(item['response'])+1 for item in part]) / num_tokens
+        batched_data = gen_batched_data(part, dims)
+        outputs = model.step_decoder(sess, batched_data, gradient_weight=weight,
+                end_of_batch=idx == len(parts)-1, soft_targets=soft_targets(batched_data))
+        loss += np.sum(outputs[0])
+    return loss, outputs[1]
 
 def generate_summary(model, sess, data_train):
     selected_data = [random.choice(data_train) for i in range(FLAGS.batch_size)]
     batched_data = gen_batched_data(selected_data)
-    summary = model.step_decoder(sess, batched_data, forward_only=True, summary=True)[-1]
+    summary = model.step_decoder(sess, batched_data, forward_only=True, summary=True, soft_targets=soft_targets(batched_data))[-1]
     return summary
 
 
-def evaluate(model, sess, data_dev, summary_writer):
-    loss = np.zeros((1, ))
-    st, ed, times = 0, FLAGS.batch_size, 0
-    while st < len(data_dev):
-        selected_data = data_dev[st:ed]
-        batched_data = gen_batched_data(selected_data)
-        outputs = model.step_decoder(sess, batched_data, forward_only=True)
-        loss += np.sum(outputs[0])
-        st, ed = ed, ed+FLAGS.batch_size
-        times += 1
-    loss /= len(data_dev)
+def evaluate(model, sess, data_dev, summary_writer, shards=1):
+    batches = [data_dev[st:st+FLAGS.batch_size] for st in range(0, len(data_dev), FLAGS.batch_size)]
+    losses = np.zeros((shards, ))
+    def evaluate_shard(shard):
+        for selected_data in batches[shard::shards]:
+            dims = batch_dims(selected_data)
+            for part in split_batch(selected_data, 'evaluate'):
+                batched_data = gen_batched_data(part, dims)
+                outputs = model.step_decoder(sess, batched_data, forward_only=True)
+                losses[shard] += np.sum(outputs[0])
+    if shards == 1:
+        evaluate_shard(0)
+    else:
+        threads = [threading.Thread(target=evaluate_shard, args=(shard, )) for shard in range(shards)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    loss = np.sum(losses) / len(data_dev)
     summary = tf.Summary()
     summary.value.add(tag='decoder_loss/dev', simple_value=loss)
     summary.value.add(tag='perplexity/dev', simple_value=np.exp(loss))
     summary_writer.add_summary(summary, model.global_step.eval())
     print('    perplexity on dev set: %.2f' % np.exp(loss))
+    return np.exp(loss)
+
+def evaluator(model, sess, data_dev):
+    checkpoint_index = CheckpointIndex(FLAGS.train_dir)
+    summary_writer = tf.summary.FileWriter('%s/log' % FLAGS.train_dir)
+    evaluated = set([entry['step'] for entry in checkpoint_index.entries() if 'dev_ppx' in entry])
+    while True:
+        for step, model_path in reversed(get_checkpoints(FLAGS.train_dir)):
+            if step in evaluated:
+                continue
+            print('evaluate %s' % model_path)
+            try:
+                model.saver.restore(sess, model_path)
+            except:
+                # rotated out by the trainer in the meantime
+                continue
+            dev_ppx = evaluate(model, sess, data_dev, summary_writer, shards=FLAGS.eval_shards or session_settings.get('sessions', 4))
+            checkpoint_index.add(step, dev_ppx=float(dev_ppx))
+            evaluated.add(step)
+        summary_writer.flush()
+        time.sleep(FLAGS.eval_interval)
 
 def get_steps(train_dir):
     a = os.walk(train_dir)
@@ -236,52 +483,151 @@ def get_steps(train_dir):
 
     return steps
 
-def test(sess, saver, data_dev, setnum=5000):
+def get_checkpoints(train_dir):
+    index = CheckpointIndex(train_dir)
+    if os.path.exists(index.path):
+        return [(entry['step'], entry['path']) for entry in reversed(index.available())]
+    # training directories written before the checkpoint index existed
+    return [(step, '%s/checkpoint-%08d' % (train_dir, step)) for step in get_steps(train_dir)]
+
+def latest_model_path(train_dir):
+    checkpoints = dict(get_checkpoints(train_dir))
+    return checkpoints[max(checkpoints)] if checkpoints else tf.train.latest_checkpoint(train_dir)
+
+def get_model_path():
+    checkpoints = dict(get_checkpoints(FLAGS.train_dir))
+    if FLAGS.inference_version == 0:
+        return latest_model_path(FLAGS.train_dir)
+    return checkpoints.get(FLAGS.inference_version, '%s/checkpoint-%08d' % (FLAGS.train_dir, FLAGS.inference_version))
+
+def score(model, sess, data):
+    # posts are batched so that their candidates fill at most one batch,
+    # each post and its subgraph is encoded once for all of its candidates
+    results = []
+    st, start_time = 0, time.time()
+    while st < len(data):
+        ed, num_candidates = st+1, len(data[st]['candidates'])
+        while ed < len(data) and num_candidates + len(data[ed]['candidates']) <= FLAGS.batch_size:
+            num_candidates += len(data[ed]['candidates'])
+            ed += 1
+        sentence_ppx = model.step_scorer(sess, gen_scoring_data(data[st:ed]))
+        offset = 0
+        for item in data[st:ed]:
+            results.append([float(np.exp(x)) for x in sentence_ppx[offset:offset+len(item['candidates'])]])
+            offset += len(item['candidates'])
+        st = ed
+    print('scored %d candidates of %d posts in %.2fs' % (sum([len(x) for x in results]), len(data), time.time() - start_time))
+    return results
+
+def sample(model, sess, data, length_policy=None):
+    num_responses = FLAGS.num_responses
+    shared_time, independent_time = .0, .0
+    truncated_num = 0
+    with open('%s.samples' % FLAGS.inference_path, 'w') as outfile:
+        for st in range(0, len(data), FLAGS.batch_size):
+            selected_data = data[st:st+FLAGS.batch_size]
+            batched_data = gen_batched_data(selected_data)
+            max_decode_length = length_policy(selected_data) if length_policy else None
+            start_time = time.time()
+            samples, truncated = model.step_sampler(sess, batched_data, num_responses,
+                    FLAGS.temperature, FLAGS.top_k, FLAGS.top_p, max_decode_length)
+            shared_time += time.time() - start_time
+            truncated_num += np.sum(truncated)
+            if FLAGS.sample_benchmark:
+                # the same responses drawn by running the whole model once per sample
+                start_time = time.time()
+                for _ in range(num_responses):
+                    model.step_sampler(sess, batched_data, 1, FLAGS.temperature, FLAGS.top_k, FLAGS.top_p, max_decode_length)
+                independent_time += time.time() - start_time
+            for idx, item in enumerate(selected_data):
+                outfile.write('post: %s\n' % ' '.join(item['post']))
+                for response in samples[idx*num_responses:(idx+1)*num_responses]:
+                    outfile.write('result: %s\n' % ' '.join(trim_response(response)))
+                outfile.write('\n')
+    print('sampled %d responses per post: %.1f posts/s, %d responses truncated' % (num_responses, len(data) / shared_time, truncated_num))
+    if FLAGS.sample_benchmark:
+        print('    independent runs: %.1f posts/s, shared encoder speedup %.2fx' % (len(data) / independent_time, independent_time / shared_time))
+
+def gen_decode_feed(data, caps=None, shortlist=None):
+    # decoding caps and shortlist of a batch, as far as they are enabled;
+    # shortlist tells whether the model has one, by default if --shortlist_size
+    if shortlist is None:
+        shortlist = FLAGS.shortlist_size > 0
+    input_feed = {}
+    if caps is not None:
+        input_feed['max_dec_lens:0'] = caps
+    if shortlist:
+        input_feed['shortlist:0'] = gen_shortlist(data)
+    return input_feed
+
+def gen_decode_feeds(data, length_policy=None, shortlist=None):
+    # the feeds decode runs, one per batch or part of a split batch; they
+    # depend on the data only, so a test over many checkpoints builds them once.
+    # The caps are those of the whole batch, whatever the parts
+    input_feeds = []
+    for st in range(0, len(data), FLAGS.batch_size):
+        selected_data = data[st:st+FLAGS.batch_size]
+        dims = batch_dims(selected_data)
+        caps = length_policy(selected_data) if length_policy is not None else None
+        offset = 0
+        for part in split_batch(selected_data, 'test'):
+            input_feed = gen_named_feed(gen_batched_data(part, dims))
+            input_feed.update(gen_decode_feed(part, caps[offset:offset+len(part)] if caps is not None else None, shortlist))
+            offset += len(part)
+            input_feeds.append(input_feed)
+    return input_feeds
+
+def decode(sess, data, length_policy=None, input_feeds=None, shortlist=None):
+    # greedy responses, perplexities and truncation flags of the data in batches
+    if input_feeds is None:
+        input_feeds = gen_decode_feeds(data, length_policy, shortlist)
+    results = []
+    loss = []
+    truncated = []
+    decode_time = .0
+    for input_feed in input_feeds:
+        start_time = time.time()
+        responses, ppx_loss, _truncated = sess.run(['decoder_1/generation:0', 'decoder/ppx_loss:0', 'decoder_1/truncated:0'], input_feed)
+        decode_time += time.time() - start_time
+        loss += [x for x in ppx_loss]
+        truncated += [x for x in _truncated]
+        results += [trim_response(response) for response in responses]
+    return results, loss, truncated, decode_time
+
+def matched_entities(item, result, stopwords):
+    entities = [kb.entities[x] for entity in item['all_entities'] for x in entity]
+    return [word for word in result if word not in stopwords and word in entities]
+
+def test(sess, saver, data_dev, setnum=5000, length_policy=None):
     with open('%s/stopwords' % FLAGS.data_dir) as f:
         stopwords = json.loads(f.readline())
-    steps = get_steps(FLAGS.train_dir)
+    checkpoints = get_checkpoints(FLAGS.train_dir)
     low_step = 00000
     high_step = 800000
+    input_feeds = None
     with open('%s.res' % FLAGS.inference_path, 'w') as resfile, open('%s.log' % FLAGS.inference_path, 'w') as outfile:
-        for step in [step for step in steps if step > low_step and step < high_step]:
+        for step, model_path in [(step, path) for step, path in checkpoints if step > low_step and step < high_step]:
             outfile.write('test for model-%d\n' % step)
-            model_path = '%s/checkpoint-%08d' % (FLAGS.train_dir, step)
             print('restore from %s' % model_path)
             try:
                 saver.restore(sess, model_path)
             except:
                 continue
-            st, ed = 0, FLAGS.batch_size
-            results = []
-            loss = []
-            while st < len(data_dev):
-                selected_data = data_dev[st:ed]
-                batched_data = gen_batched_data(selected_data)
-                responses, ppx_loss = sess.run(['decoder_1/generation:0', 'decoder/ppx_loss:0'], {'enc_inps:0': batched_data['posts'], 'enc_lens:0': batched_data['posts_length'], 'dec_inps:0': batched_data['responses'], 'dec_lens:0': batched_data['responses_length'], 'entities:0': batched_data['entities'], 'triples:0': batched_data['triples'], 'match_triples:0': batched_data['match_triples'], 'enc_triples:0': batched_data['posts_triple'], 'dec_triples:0': batched_data['responses_triple']})
-                loss += [x for x in ppx_loss]
-                for response in responses:
-                    result = []
-                    for token in response:
-                        if token != '_EOS':
-                            result.append(token)
-                        else:
-                            break
-                    results.append(result)
-                st, ed = ed, ed+FLAGS.batch_size
+            if input_feeds is None:
+                # built once, every checkpoint decodes the same feeds and
+                # matches against the same entities
+                input_feeds = gen_decode_feeds(data_dev, length_policy)
+                item_entities = [set([kb.entities[x] for entity in item['all_entities'] for x in entity]) for item in data_dev]
+            results, loss, truncated, decode_time = decode(sess, data_dev, input_feeds=input_feeds)
             match_entity_sum = [.0] * 4
             cnt = 0
-            for post, response, result, match_triples, triples, entities in zip([data['post'] for data in data_dev], [data['response'] for data in data_dev], results, [data['match_triples'] for data in data_dev], [data['all_triples'] for data in data_dev], [data['all_entities'] for data in data_dev]):
+            for post, response, result, entities, result_truncated in zip([data['post'] for data in data_dev], [data['response'] for data in data_dev], results, item_entities, truncated):
                 setidx = cnt / setnum
                 result_matched_entities = []
-                triples = [csk_triples[tri] for triple in triples for tri in triple]
-                match_triples = [csk_triples[triple] for triple in match_triples]
-                entities = [csk_entities[x] for entity in entities for x in entity]
-                matches = [x for triple in match_triples for x in [triple.split(', ')[0], triple.split(', ')[2]] if x in response]
-                
                 for word in result:
                     if word not in stopwords and word in entities:
                         result_matched_entities.append(word)
-                outfile.write('post: %s\nresponse: %s\nresult: %s\nmatch_entity: %s\n\n' % (' '.join(post), ' '.join(response), ' '.join(result), ' '.join(result_matched_entities)))
+                outfile.write('post: %s\nresponse: %s\nresult: %s\nmatch_entity: %s\ntruncated: %s\n\n' % (' '.join(post), ' '.join(response), ' '.join(result), ' '.join(result_matched_entities), bool(result_truncated)))
                 match_entity_sum[setidx] += len(set(result_matched_entities))
                 cnt += 1
             match_entity_sum = [m / setnum for m in match_entity_sum] + [sum(match_entity_sum) / len(data_dev)]
@@ -289,16 +635,300 @@ def test(sess, saver, data_dev, setnum=5000):
             losses = [np.exp(x) for x in losses]
             def show(x):
                 return ', '.join([str(v) for v in x])
-            outfile.write('model: %d\n\tperplexity: %s\n\tmatch_entity_rate: %s\n%s\n\n' % (step, show(losses), show(match_entity_sum), '='*50))
-            resfile.write('model: %d\n\tperplexity: %s\n\tmatch_entity_rate: %s\n\n' % (step, show(losses), show(match_entity_sum)))
+            truncated_rate = np.mean(truncated)
+            outfile.write('model: %d\n\tperplexity: %s\n\tmatch_entity_rate: %s\n\ttruncated_rate: %s\n\tdecode_time: %.2f\n%s\n\n' % (step, show(losses), show(match_entity_sum), truncated_rate, decode_time, '='*50))
+            resfile.write('model: %d\n\tperplexity: %s\n\tmatch_entity_rate: %s\n\ttruncated_rate: %s\n\tdecode_time: %.2f\n\n' % (step, show(losses), show(match_entity_sum), truncated_rate, decode_time))
             outfile.flush()
             resfile.flush()
     return results
 
-config = tf.ConfigProto()
+def generate_raw(generator, data):
+    # raw posts have no reference response, so only the generations and the
+    # cache metrics are written. A checkpoint written meanwhile (unless
+    # inference_version pins one) is restored between batches, which clears
+    # the caches
+    with open('%s.res' % FLAGS.raw_path, 'w') as outfile:
+        for st in range(0, len(data), FLAGS.batch_size):
+            model_path = get_model_path()
+            if model_path != generator.checkpoint:
+                print('restore from %s' % model_path)
+                generator.restore(generator.model.saver, model_path)
+            selected_data = data[st:st+FLAGS.batch_size]
+            for item, result in zip(selected_data, generator.generate(selected_data)):
+                outfile.write('post: %s\nresult: %s\n\n' % (' '.join(item['post']), ' '.join(result)))
+    metrics = generator.metrics()
+    print(', '.join(['%s %.3f' % (name, metrics[name]) for name in sorted(metrics)]))
+
+def stream_raw(decoder, data):
+    # one line per token as it is chosen: index of the post and the token
+    with open('%s.res' % FLAGS.raw_path, 'w') as outfile:
+        for st in range(0, len(data), FLAGS.batch_size):
+            selected_data = data[st:st+FLAGS.batch_size]
+            results = [[] for _ in selected_data]
+            for tokens in decoder.stream(selected_data):
+                for i, token in enumerate(tokens):
+                    if token is not None:
+                        results[i].append(token)
+                        print('%d %s' % (st + i, token))
+                sys.stdout.flush()
+            for item, result in zip(selected_data, results):
+                outfile.write('post: %s\nresult: %s\n\n' % (' '.join(item['post']), ' '.join(result)))
+    metrics = decoder.metrics()
+    print(', '.join(['%s %.3f' % (name, metrics[name]) for name in sorted(metrics)]))
+
+def autotune(data):
+    # times each candidate setting on dev batches with concurrent sessions of
+    # one graph and keeps the highest throughput per mode for this host
+    FLAGS.is_train = False    # batches with entities serve all three graphs
+    batches = [gen_batched_data(data[st:st+FLAGS.batch_size])
+            for st in range(0, min(len(data), FLAGS.autotune_batches*FLAGS.batch_size), FLAGS.batch_size)]
+    model_path = get_model_path()
+    for mode in ['train', 'evaluate', 'inference']:
+        best = None
+        for settings in candidate_settings():
+            with tf.Graph().as_default() as graph:
+                model = Model(
+                        FLAGS.symbols,
+                        FLAGS.embed_units,
+                        FLAGS.units,
+                        FLAGS.layers,
+                        embed=None,
+                        num_entities=FLAGS.num_entities+FLAGS.num_relations,
+                        num_trans_units=FLAGS.trans_units,
+                        forward_only=mode != 'train',
+                        inference_decoder=mode == 'inference',
+                        **dict(model_options(), parallel_iterations=settings['parallel_iterations']))
+                def init(sess):
+                    # decoding runs until _EOS, only trained weights time it realistically
+                    if model_path:
+                        model.saver.restore(sess, model_path)
+                    else:
+                        sess.run(tf.global_variables_initializer())
+                    sess.run(tf.local_variables_initializer())
+                if mode == 'inference':
+                    step = lambda sess, i: sess.run(model.generation, gen_named_feed(batches[i % len(batches)]))
+                else:
+                    step = lambda sess, i: model.step_decoder(sess, batches[i % len(batches)], forward_only=mode != 'train')
+                examples_per_sec = time_sessions(graph, settings, init, step, len(batches)) * FLAGS.batch_size
+            print('%s %s: %.1f examples/s' % (mode, ' '.join(['%s=%d' % item for item in sorted(settings.items())]), examples_per_sec))
+            if best is None or examples_per_sec > best['examples_per_sec']:
+                best = dict(settings, examples_per_sec=examples_per_sec)
+        save_session_settings(FLAGS.train_dir, mode, best)
+        print('best for %s: %s' % (mode, best))
+
+def profile_memory():
+    # one step per memory_profile dims on batches of words and triples of the
+    # knowledge base, with the weights of the latest checkpoint if there is
+    # one; unrestored tables map everything to _UNK, which changes no shape.
+    # The fitted modes replace those calibrated for --memory_budget.
+    global kb, memory_model
+    kb = KBStore.open(FLAGS.data_dir)
+    words = build_vocab_list(kb.vocab)[len(_START_VOCAB):]
+    entities = list(kb.entities)
+    relations = list(kb.relations)
+    model = Model(
+            FLAGS.symbols,
+            FLAGS.embed_units,
+            FLAGS.units,
+            FLAGS.layers,
+            embed=None,
+            num_entities=FLAGS.num_entities+FLAGS.num_relations,
+            num_trans_units=FLAGS.trans_units,
+            forward_only=not FLAGS.is_train,
+            inference_decoder=not FLAGS.is_train,
+            recompute_attention=FLAGS.recompute_attention,
+            swap_memory=FLAGS.swap_memory,
+            **model_options())
+    model_path = get_model_path()
+    if model_path:
+        model.saver.restore(sess, model_path)
+    else:
+        sess.run(tf.global_variables_initializer())
+    sess.run(tf.local_variables_initializer())
+    if FLAGS.is_train:
+        fetches = {'train': [model.sentence_ppx, model.batch_gradient_norm], 'evaluate': [model.sentence_ppx]}
+    else:
+        fetches = {'test': ['decoder_1/generation:0', 'decoder/ppx_loss:0']}
+    if not os.path.exists(FLAGS.train_dir):
+        os.makedirs(FLAGS.train_dir)
+    memory_model = MemoryCostModel.load('%s/memory_model.json' % FLAGS.train_dir, FLAGS.symbols, FLAGS.units, FLAGS.trans_units)
+    rng = np.random.RandomState(0)
+    for mode in sorted(fetches):
+        profiles = []
+        for text in FLAGS.memory_profile.split(','):
+            dims = parse_dims(text)
+            input_feed = gen_named_feed(synthetic_batch(dims, words, entities, relations, rng))
+            sess.run(fetches[mode], input_feed)
+            profiles.append((dims, ) + profile_step(sess, fetches[mode], input_feed))
+        report = memory_report(memory_model, mode, profiles)
+        with open('%s/memory_profile_%s.txt' % (FLAGS.train_dir, mode), 'w') as f:
+            f.write(report + '\n')
+        print(report)
+    memory_model.save('%s/memory_model.json' % FLAGS.train_dir)
+
+def compare_models(data, variants, config):
+    # decodes data with each (name, checkpoint, units, layers, trans_units,
+    # Model options) variant in a graph of its own, returns a report of their
+    # perplexity, match entity rate and latency and the responses of each
+    with open('%s/stopwords' % FLAGS.data_dir) as f:
+        stopwords = json.loads(f.readline())
+    num_batches = (len(data) + FLAGS.batch_size - 1) // FLAGS.batch_size
+    report, responses = [], {}
+    for name, path, units, layers, trans_units, options in variants:
+        with tf.Graph().as_default(), tf.Session(config=config) as sess:
+            model = Model(
+                    FLAGS.symbols,
+                    FLAGS.embed_units,
+                    units,
+                    layers,
+                    embed=None,
+                    num_entities=FLAGS.num_entities+FLAGS.num_relations,
+                    num_trans_units=trans_units,
+                    forward_only=True,
+                    **dict(model_options(), **options))
+            model.saver.restore(sess, path)
+            # the models compared are built without a shortlist unless their
+            # options ask for one
+            results, loss, truncated, decode_time = decode(sess, data, shortlist=options.get('shortlist', False))
+        responses[name] = results
+        match_entity_rate = np.mean([len(set(matched_entities(item, result, stopwords))) for item, result in zip(data, results)])
+        report.append('%s:\n\tperplexity: %.4f\n\tmatch_entity_rate: %.4f\n\tlatency: %.1f ms/batch\n'
+                % (name, np.exp(np.sum(loss) / len(data)), match_entity_rate, decode_time / num_batches * 1000))
+    return report, responses
+
+def distill_report(data):
+    # the student of train_dir against its teacher, both decoding on the CPU
+    cpu_config = tf.ConfigProto()
+    cpu_config.CopyFrom(config)
+    cpu_config.device_count['GPU'] = 0
+    report, _ = compare_models(data, [
+            ('teacher', latest_model_path(FLAGS.distill_from), FLAGS.teacher_units, FLAGS.teacher_layers, FLAGS.teacher_trans_units, teacher_options()),
+            ('student', get_model_path(), FLAGS.units, FLAGS.layers, FLAGS.trans_units, {})], cpu_config)
+    with open('%s/distillation_report' % FLAGS.train_dir, 'w') as f:
+        f.write(''.join(report))
+    print(''.join(report))
+
+def softmax_report(data):
+    # the adaptive softmax of train_dir against a flat one
+    report, _ = compare_models(data, [
+            ('flat softmax', latest_model_path(FLAGS.flat_softmax_from), FLAGS.units, FLAGS.layers, FLAGS.trans_units, {'softmax_cutoffs': []}),
+            ('adaptive softmax %s' % FLAGS.softmax_cutoffs, get_model_path(), FLAGS.units, FLAGS.layers, FLAGS.trans_units, {})], config)
+    with open('%s/softmax_report' % FLAGS.train_dir, 'w') as f:
+        f.write(''.join(report))
+    print(''.join(report))
+
+def memory_dtype_report(data):
+    # the same checkpoint decoding with float32 memories and with memory_dtype
+    model_path = get_model_path()
+    report, _ = compare_models(data, [
+            ('float32 memories', model_path, FLAGS.units, FLAGS.layers, FLAGS.trans_units, {'memory_dtype': 'float32'}),
+            ('%s memories' % FLAGS.memory_dtype, model_path, FLAGS.units, FLAGS.layers, FLAGS.trans_units, {})], config)
+    with open('%s/memory_dtype_report' % FLAGS.train_dir, 'w') as f:
+        f.write(''.join(report))
+    print(''.join(report))
+
+def quantize(data):
+    # int8 copy of the inference checkpoint without the optimizer slots, and
+    # a comparison of both on data
+    model_path = get_model_path()
+    step = int(model_path.split('-')[-1])
+    quantized_dir = '%s/quantized' % FLAGS.train_dir
+    if not os.path.exists(quantized_dir):
+        os.makedirs(quantized_dir)
+    def quantize_fn(name, value):
+        if re.search(r'(Adam(_1)?|beta[12]_power)$', name):
+            return []
+        return quantize_variable(block_cell_variable_name(name, to_block=False), value)
+    quantized_path = transform_checkpoint(model_path, '%s/checkpoint' % quantized_dir, quantize_fn, step)
+    CheckpointIndex(quantized_dir).add(step, path=quantized_path)
+    print('quantized %s to %s' % (model_path, quantized_path))
+
+    report, responses = compare_models(data, [
+            ('float32', model_path, FLAGS.units, FLAGS.layers, FLAGS.trans_units, {}),
+            ('int8', quantized_path, FLAGS.units, FLAGS.layers, FLAGS.trans_units, {'quantized': True})], config)
+    agreement = np.mean([x == y for x, y in zip(responses['float32'], responses['int8'])])
+    report.append('identical responses: %.4f\n' % agreement)
+    with open('%s/quantization_report' % quantized_dir, 'w') as f:
+        f.write(''.join(report))
+    print(''.join(report))
+
+config = session_config(session_settings)
 config.gpu_options.allow_growth = True
+if FLAGS.is_evaluator and FLAGS.eval_threads:
+    config.intra_op_parallelism_threads = FLAGS.eval_threads
 with tf.Session(config=config) as sess:
-    if FLAGS.is_train:
+    if FLAGS.convert_checkpoint:
+        # GRUCell <-> GRUBlockCell, in the direction selected by --block_cells
+        if os.path.abspath(os.path.dirname(FLAGS.convert_checkpoint)) == os.path.abspath(FLAGS.train_dir):
+            raise ValueError("Converted checkpoints need a train_dir apart from %s" % FLAGS.convert_checkpoint)
+        step = int(FLAGS.convert_checkpoint.split('-')[-1])
+        model_path = rename_checkpoint(FLAGS.convert_checkpoint, '%s/checkpoint' % FLAGS.train_dir,
+                lambda name: block_cell_variable_name(name, to_block=FLAGS.block_cells), step)
+        CheckpointIndex(FLAGS.train_dir).add(step, path=model_path)
+        print('converted %s to %s' % (FLAGS.convert_checkpoint, model_path))
+    elif FLAGS.memory_profile:
+        profile_memory()
+    elif FLAGS.autotune:
+        raw_vocab, data_train, data_dev, data_test = prepare_data(FLAGS.data_dir, is_train=False)
+        autotune(data_dev)
+    elif FLAGS.quantize:
+        FLAGS.is_train = False
+        raw_vocab, data_train, data_dev, data_test = prepare_data(FLAGS.data_dir, is_train=False)
+        quantize(data_test)
+    elif FLAGS.compare_memory_dtype:
+        FLAGS.is_train = False
+        raw_vocab, data_train, data_dev, data_test = prepare_data(FLAGS.data_dir, is_train=False)
+        memory_dtype_report(data_test)
+    elif FLAGS.flat_softmax_from and not FLAGS.is_train:
+        raw_vocab, data_train, data_dev, data_test = prepare_data(FLAGS.data_dir, is_train=False)
+        softmax_report(data_test)
+    elif FLAGS.distill_from and not FLAGS.is_train:
+        raw_vocab, data_train, data_dev, data_test = prepare_data(FLAGS.data_dir, is_train=False)
+        distill_report(data_test)
+    elif FLAGS.is_evaluator:
+        model = build_model(
+                FLAGS.symbols, 
+                FLAGS.embed_units,
+                FLAGS.units, 
+                FLAGS.layers,
+                embed=None,
+                num_entities=FLAGS.num_entities+FLAGS.num_relations,
+                num_trans_units=FLAGS.trans_units,
+                forward_only=True,
+                inference_decoder=False,
+                **model_options())
+        raw_vocab, data_train, data_dev, data_test = prepare_data(FLAGS.data_dir, is_train=False)
+        if FLAGS.memory_budget > 0:
+            memory_model = MemoryCostModel.load('%s/memory_model.json' % FLAGS.train_dir, FLAGS.symbols, FLAGS.units, FLAGS.trans_units)
+            # normally fitted by the trainer already, otherwise on its newest checkpoint
+            model_path = get_model_path()
+            if model_path and not memory_model.has('evaluate'):
+                model.saver.restore(sess, model_path)
+                calibrate_memory(sess, data_dev, 'evaluate', [model.sentence_ppx])
+        evaluator(model, sess, data_dev)
+    elif FLAGS.score_path:
+        model = build_model(
+                FLAGS.symbols, 
+                FLAGS.embed_units,
+                FLAGS.units, 
+                FLAGS.layers,
+                embed=None,
+                num_entities=FLAGS.num_entities+FLAGS.num_relations,
+                num_trans_units=FLAGS.trans_units,
+                forward_only=True,
+                inference_decoder=False,
+                shared_posts=True,
+                **model_options())
+        model_path = get_model_path()
+        print('restore from %s' % model_path)
+        model.saver.restore(sess, model_path)
+        raw_vocab, data_train, data_dev, data_test = prepare_data(FLAGS.data_dir, is_train=False)
+        with open(FLAGS.score_path) as f:
+            data = [json.loads(line) for line in f]
+        with open('%s.score' % FLAGS.score_path, 'w') as f:
+            for ppx in score(model, sess, data):
+                f.write(json.dumps(ppx) + '\n')
+    elif FLAGS.is_train:
         raw_vocab, data_train, data_dev, data_test = prepare_data(FLAGS.data_dir)
         vocab, embed, entity_vocab, entity_embed, relation_vocab, relation_embed, entity_relation_embed = build_vocab(FLAGS.data_dir, raw_vocab)
         FLAGS.num_entities = len(entity_vocab)
@@ -311,7 +941,29 @@ with tf.Session(config=config) as sess:
                 embed,
                 entity_relation_embed,
                 num_entities=len(entity_vocab)+len(relation_vocab),
-                num_trans_units=FLAGS.trans_units)
+                num_trans_units=FLAGS.trans_units,
+                grad_accum_steps=FLAGS.grad_accum_steps,
+                clip_micro_batches=FLAGS.clip_micro_batches,
+                accumulate_gradients=FLAGS.memory_budget > 0,
+                recompute_attention=FLAGS.recompute_attention,
+                swap_memory=FLAGS.swap_memory,
+                distill_weight=FLAGS.distill_weight if FLAGS.distill_from else 0.,
+                **model_options())
+        if FLAGS.distill_from:
+            teacher_path = latest_model_path(FLAGS.distill_from)
+            print("Distilling the teacher %s" % teacher_path)
+            teacher = Teacher(lambda: Model(
+                    FLAGS.symbols,
+                    FLAGS.embed_units,
+                    FLAGS.teacher_units,
+                    FLAGS.teacher_layers,
+                    embed=None,
+                    num_entities=len(entity_vocab)+len(relation_vocab),
+                    num_trans_units=FLAGS.teacher_trans_units,
+                    forward_only=True,
+                    inference_decoder=False,
+                    teacher_top_k=FLAGS.distill_top_k,
+                    **teacher_options()), teacher_path, config)
         if tf.train.get_checkpoint_state(FLAGS.train_dir):
             print("Reading model parameters from %s" % FLAGS.train_dir)
             model.saver.restore(sess, tf.train.latest_checkpoint(FLAGS.train_dir))
@@ -331,57 +983,115 @@ with tf.Session(config=config) as sess:
                 range(len(entity_vocab)+len(relation_vocab)), dtype=tf.int64), constant_op.constant(entity_vocab+relation_vocab))
             sess.run(op_out)
 
+        checkpoint_index = CheckpointIndex(FLAGS.train_dir)
+        checkpoint_saver = AsyncSaver(tf.global_variables(), index=checkpoint_index,
+                write_version=tf.train.SaverDef.V2, max_to_keep=3, pad_step_number=True, keep_checkpoint_every_n_hours=1.0)
+
+        # gradient accumulators and the snapshots of the checkpoint saver are
+        # not part of the checkpoints
+        sess.run(tf.local_variables_initializer())
+
         if FLAGS.log_parameters:
             model.print_parameters()
 
+        if FLAGS.memory_budget > 0:
+            memory_model = MemoryCostModel.load('%s/memory_model.json' % FLAGS.train_dir, FLAGS.symbols, FLAGS.units, FLAGS.trans_units)
+            calibrate_memory(sess, data_dev, 'train', [model.sentence_ppx, model.batch_gradient_norm])
+            calibrate_memory(sess, data_dev, 'evaluate', [model.sentence_ppx])
+
+
         summary_writer = tf.summary.FileWriter('%s/log' % FLAGS.train_dir, sess.graph)
         loss_step, time_step = np.zeros((1, )), .0
         previous_losses = [1e18]*3
         train_len = len(data_train)
+        # a checkpoint every per_checkpoint updates of grad_accum_steps batches each
+        checkpoint_len = FLAGS.batch_size * FLAGS.grad_accum_steps * FLAGS.per_checkpoint
         while True:
-            st, ed = 0, FLAGS.batch_size * FLAGS.per_checkpoint
+            st, ed = 0, checkpoint_len
             random.shuffle(data_train)
             while st < train_len:
                 start_time = time.time()
+                gradient_norms = []
                 for batch in range(st, ed, FLAGS.batch_size):
-                    loss_step += train(model, sess, data_train[batch:batch+FLAGS.batch_size]) / (ed - st)
+                    loss, gradient_norm = train(model, sess, data_train[batch:batch+FLAGS.batch_size])
+                    loss_step += loss / (ed - st)
+                    if gradient_norm is not None:
+                        gradient_norms.append(gradient_norm)
 
                 show = lambda a: '[%s]' % (' '.join(['%.2f' % x for x in a]))
-                print("global step %d learning rate %.4f step-time %.2f loss %f perplexity %s"
+                print("global step %d learning rate %.4f step-time %.2f gradient-norm %.2f loss %f perplexity %s"
                         % (model.global_step.eval(), model.lr, 
-                            (time.time() - start_time) / ((ed - st) / FLAGS.batch_size), loss_step, show(np.exp(loss_step))))
-                model.saver.save(sess, '%s/checkpoint' % FLAGS.train_dir, 
-                        global_step=model.global_step)
+                            (time.time() - start_time) / max(len(gradient_norms), 1), np.mean(gradient_norms or [0]), loss_step, show(np.exp(loss_step))))
+                global_step = model.global_step.eval()
+                checkpoint_saver.save(sess, '%s/checkpoint' % FLAGS.train_dir, global_step)
                 summary = tf.Summary()
                 summary.value.add(tag='decoder_loss/train', simple_value=loss_step)
                 summary.value.add(tag='perplexity/train', simple_value=np.exp(loss_step))
                 summary_writer.add_summary(summary, model.global_step.eval())
                 summary_model = generate_summary(model, sess, data_train)
                 summary_writer.add_summary(summary_model, model.global_step.eval())
-                evaluate(model, sess, data_dev, summary_writer)
+                if FLAGS.inline_eval:
+                    dev_ppx = evaluate(model, sess, data_dev, summary_writer)
+                    checkpoint_index.add(global_step, dev_ppx=float(dev_ppx))
                 previous_losses = previous_losses[1:]+[np.sum(loss_step)]
                 loss_step, time_step = np.zeros((1, )), .0
-                st, ed = ed, min(train_len, ed + FLAGS.batch_size * FLAGS.per_checkpoint)
+                st, ed = ed, min(train_len, ed + checkpoint_len)
             model.saver_epoch.save(sess, '%s/epoch/checkpoint' % FLAGS.train_dir, global_step=model.global_step)
     else:
-        model = Model(
+        model = build_model(
                 FLAGS.symbols, 
                 FLAGS.embed_units,
                 FLAGS.units, 
                 FLAGS.layers,
                 embed=None,
                 num_entities=FLAGS.num_entities+FLAGS.num_relations,
-                num_trans_units=FLAGS.trans_units)
+                num_trans_units=FLAGS.trans_units,
+                sampling_decoder=FLAGS.num_responses > 0,
+                forward_only=FLAGS.quantized,
+                quantized=FLAGS.quantized,
+                shortlist=FLAGS.shortlist_size > 0,
+                shortlist_fallback=FLAGS.shortlist_fallback,
+                **model_options())
 
-        if FLAGS.inference_version == 0:
-            model_path = tf.train.latest_checkpoint(FLAGS.train_dir)
-        else:
-            model_path = '%s/checkpoint-%08d' % (FLAGS.train_dir, FLAGS.inference_version)
+        model_path = get_model_path()
         print('restore from %s' % model_path)
         model.saver.restore(sess, model_path)
         saver = model.saver
 
         raw_vocab, data_train, data_dev, data_test = prepare_data(FLAGS.data_dir, is_train=False)
+        symbol_ids = dict([(word, i) for i, word in enumerate(build_vocab_list(raw_vocab))])
+        if FLAGS.raw_path:
+            with open('%s/stopwords' % FLAGS.data_dir) as f:
+                stopwords = json.loads(f.readline())
+            kb_index = EntityTripleIndex(kb, stopwords,
+                    max_subgraphs=FLAGS.max_subgraphs, max_subgraph_size=FLAGS.max_subgraph_size)
+            with open(FLAGS.raw_path) as f:
+                data_test = [kb_index.raw_item(line) for line in f if line.strip()]
+
+        length_policy = None
+        if FLAGS.decode_length_policy != 'fixed':
+            length_policy = DecodeLengthPolicy([(len(item['post']), len(item['response'])) for item in data_dev],
+                    mode=FLAGS.decode_length_policy, quantile=FLAGS.decode_length_quantile, margin=FLAGS.decode_length_margin)
 
-        test(sess, saver, data_test, setnum=5000)
+        decode_feed_fn = lambda data: gen_decode_feed(data, length_policy(data) if length_policy is not None else None)
+        if FLAGS.raw_path and FLAGS.raw_test:
+            # raw posts have no reference, their perplexity is that of an
+            # empty response
+            test(sess, saver, data_test, setnum=max((len(data_test) + 3) // 4, 1), length_policy=length_policy)
+        elif FLAGS.raw_path and FLAGS.stream:
+            stream_raw(StreamingDecoder(model, sess, gen_batched_data, feed_fn=decode_feed_fn), data_test)
+        elif FLAGS.raw_path:
+            generator = CachedGenerator(model, sess, gen_batched_data, model_path,
+                    response_cache_size=FLAGS.response_cache_size, encoder_cache_bytes=FLAGS.encoder_cache_mb * 2**20,
+                    feed_fn=decode_feed_fn,
+                    settings=(FLAGS.decode_length_policy, FLAGS.shortlist_size, FLAGS.shortlist_fallback),
+                    subgraph_cache_bytes=FLAGS.subgraph_cache_mb * 2**20)
+            generate_raw(generator, data_test)
+        elif FLAGS.num_responses > 0:
+            sample(model, sess, data_test, length_policy)
+        else:
+            if FLAGS.memory_budget > 0:
+                memory_model = MemoryCostModel.load('%s/memory_model.json' % FLAGS.train_dir, FLAGS.symbols, FLAGS.units, FLAGS.trans_units)
+                calibrate_memory(sess, data_dev, 'test', ['decoder_1/generation:0', 'decoder/ppx_loss:0'])
+            test(sess, saver, data_test, setnum=5000, length_policy=length_policy)
 
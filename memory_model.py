@@ -0,0 +1,205 @@
+import collections
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+def batch_dims(data):
+    # the padded dimensions gen_batched_data gives a batch of these items;
+    # posts without any subgraph still get the placeholder triple
+    return {'batch_size': len(data),
+            'encoder_len': max([len(item['post']) for item in data])+1,
+            'decoder_len': max([len(item['response']) for item in data])+1,
+            'triple_num': max([len(item['all_triples']) for item in data])+1,
+            'triple_len': max([1] + [len(tri) for item in data for tri in item['all_triples']])}
+
+DIMS = ['batch_size', 'encoder_len', 'decoder_len', 'triple_num', 'triple_len']
+
+# the terms of MemoryCostModel.features
+FEATURE_NAMES = ['constant',
+        'batch*decoder_len*symbols',
+        'batch*decoder_len*triples*units',
+        'batch*triples*(units+3*trans_units)',
+        'batch*decoder_len*triples',
+        'batch*(encoder_len+decoder_len)*units']
+
+def format_dims(dims):
+    return 'x'.join([str(dims[name]) for name in DIMS])
+
+def parse_dims(text):
+    # batch x encoder_len x decoder_len x triple_num x triple_len, e.g. 100x20x20x10x30
+    return dict(zip(DIMS, [int(x) for x in text.split('x')]))
+
+def synthetic_batch(dims, words, entities, relations, rng):
+    # a batch shaped like the output of gen_batched_data, padded to dims and
+    # drawn from the given words, entities and relations, with a match in
+    # every fifth response word
+    batch_size, encoder_len, decoder_len = dims['batch_size'], dims['encoder_len'], dims['decoder_len']
+    triple_num, triple_len = dims['triple_num'], dims['triple_len']
+    words, entities, relations = np.array(words), np.array(entities), np.array(relations)
+    posts = rng.choice(words, (batch_size, encoder_len))
+    posts[:, -1] = '_EOS'
+    responses = rng.choice(words, (batch_size, decoder_len))
+    responses[:, -1] = '_EOS'
+    triples = np.stack([rng.choice(entities, (batch_size, triple_num, triple_len)),
+        rng.choice(relations, (batch_size, triple_num, triple_len)),
+        rng.choice(entities, (batch_size, triple_num, triple_len))], axis=3)
+    responses_triple = np.tile(np.array(['_NAF_H', '_NAF_R', '_NAF_T'], dtype=object), (batch_size, decoder_len, 1))
+    match_triples = -np.ones((batch_size, decoder_len, triple_num), dtype=np.int32)
+    for i in range(batch_size):
+        for j in range(0, decoder_len - 1, 5):
+            k, l = rng.randint(1, triple_num), rng.randint(triple_len)
+            match_triples[i, j, k] = l
+            responses_triple[i, j+1] = triples[i, k, l]
+    return {'posts': posts,
+            'responses': responses,
+            'posts_length': [encoder_len] * batch_size,
+            'responses_length': [decoder_len] * batch_size,
+            'triples': triples,
+            'entities': rng.choice(words, (batch_size, triple_num, triple_len)),
+            'posts_triple': rng.randint(0, triple_num, (batch_size, encoder_len, 1)),
+            'responses_triple': responses_triple,
+            'match_triples': match_triples}
+
+def profile_step(sess, fetches, feed_dict):
+    """Runs fetches once with a full trace and returns what the step allocated.
+
+    Returns the peak memory, the bytes allocated per op and per tensor
+    (name -> (bytes, shape)). An op in a loop allocates once per iteration,
+    its bytes are the total over the step. The peak is the largest allocator
+    usage seen after any op. Allocators that do not track their usage (the
+    default CPU allocator) report none, then the bytes of every tensor the
+    step produced are summed instead, which overestimates the peak but grows
+    with the batch the same way.
+    """
+    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    run_metadata = tf.RunMetadata()
+    sess.run(fetches, feed_dict, options=run_options, run_metadata=run_metadata)
+    peak, produced = 0, 0
+    ops, tensors = collections.defaultdict(int), {}
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                peak = max(peak, memory.allocator_bytes_in_use, memory.peak_bytes)
+            for output in node_stats.output:
+                num_bytes = output.tensor_description.allocation_description.requested_bytes
+                produced += num_bytes
+                ops[node_stats.node_name] += num_bytes
+                name = '%s:%d' % (node_stats.node_name, output.slot)
+                shape = [dim.size for dim in output.tensor_description.shape.dim]
+                tensors[name] = (tensors.get(name, (0, ))[0] + num_bytes, shape)
+    return peak or produced, dict(ops), tensors
+
+def measure_bytes(sess, fetches, feed_dict):
+    # the peak memory of a step
+    return profile_step(sess, fetches, feed_dict)[0]
+
+def memory_report(memory_model, mode, profiles, top=15):
+    """Fits memory_model to profiled steps and describes them as text.
+
+    profiles are (dims, peak, ops, tensors) as returned with profile_step.
+    The report has the peak and the ops allocating most per profiled dims,
+    the largest tensors of the largest step and the fitted scaling model
+    with its error on every profile.
+    """
+    mb = lambda x: x / float(2**20)
+    profiles = sorted(profiles, key=lambda profile: profile[1])
+    memory_model.fit(mode, [(dims, peak) for dims, peak, _, _ in profiles])
+    largest_dims, _, largest_ops, largest_tensors = profiles[-1]
+    lines = ['memory of %s steps in MB, by batch x encoder_len x decoder_len x triple_num x triple_len' % mode,
+            '%-60s %s' % ('', ' '.join(['%18s' % format_dims(dims) for dims, _, _, _ in profiles])),
+            '%-60s %s' % ('peak', ' '.join(['%18.1f' % mb(peak) for _, peak, _, _ in profiles]))]
+    for op in sorted(largest_ops, key=largest_ops.get, reverse=True)[:top]:
+        lines.append('%-60s %s' % (op[-60:], ' '.join(['%18.1f' % mb(ops.get(op, 0)) for _, _, ops, _ in profiles])))
+    lines += ['', 'largest tensors at %s' % format_dims(largest_dims)]
+    for name in sorted(largest_tensors, key=lambda name: largest_tensors[name][0], reverse=True)[:top]:
+        num_bytes, shape = largest_tensors[name]
+        lines.append('%-60s %-24s %10.1f' % (name[-60:], shape, mb(num_bytes)))
+    lines += ['', 'scaling model, bytes = sum of coefficient x term']
+    features = memory_model.features(largest_dims)
+    for term, coefficient, feature in zip(FEATURE_NAMES, memory_model.coefficients[mode], features):
+        lines.append('%-36s %14.6g    %10.1f MB at %s' % (term, coefficient, mb(coefficient * feature), format_dims(largest_dims)))
+    for dims, peak, _, _ in profiles:
+        estimate = memory_model.estimate(mode, dims)
+        lines.append('%-18s measured %10.1f MB estimated %10.1f MB error %+.1f%%' % (format_dims(dims),
+            mb(peak), mb(estimate), (estimate - peak) * 100. / max(peak, 1)))
+    return '\n'.join(lines)
+
+
+class MemoryCostModel(object):
+    """Estimates the memory of a step from the padded dimensions of its batch.
+
+    The estimate is linear in the sizes of the tensors that dominate the graph:
+    the output distributions (batch x decoder_len x vocab), the attention over
+    the triples at every decoding step (batch x decoder_len x triples, once per
+    unit and once per probability), the knowledge memories (batch x triples x
+    units) and the encoder and decoder states. The coefficients are fitted per
+    mode ('train', 'evaluate', 'test') from steps measured with measure_bytes,
+    since a training step also keeps the activations for the gradients.
+    """
+    def __init__(self, num_symbols, num_units, num_trans_units, coefficients=None):
+        self.num_symbols = num_symbols
+        self.num_units = num_units
+        self.num_trans_units = num_trans_units
+        self.coefficients = dict(coefficients or {})
+
+    def features(self, dims):
+        batch_size, encoder_len, decoder_len = dims['batch_size'], dims['encoder_len'], dims['decoder_len']
+        triples = dims['triple_num'] * dims['triple_len']
+        return np.array([1.,
+                batch_size * decoder_len * self.num_symbols,
+                batch_size * decoder_len * triples * self.num_units,
+                batch_size * triples * (self.num_units + 3 * self.num_trans_units),
+                batch_size * decoder_len * triples,
+                batch_size * (encoder_len + decoder_len) * self.num_units], dtype=np.float64)
+
+    def fit(self, mode, samples):
+        # samples are (dims, bytes) pairs; the columns are scaled to a common
+        # range before solving and negative coefficients are dropped, a
+        # tensor never takes negative memory
+        x = np.array([self.features(dims) for dims, _ in samples])
+        y = np.array([float(measured) for _, measured in samples])
+        scale = np.maximum(np.max(np.abs(x), axis=0), 1e-12)
+        coefficients = np.linalg.lstsq(x / scale, y, rcond=-1)[0] / scale
+        self.coefficients[mode] = [float(c) for c in np.maximum(coefficients, 0)]
+
+    def has(self, mode):
+        return mode in self.coefficients
+
+    def estimate(self, mode, dims):
+        return float(np.dot(self.coefficients[mode], self.features(dims)))
+
+    def split(self, data, mode, budget, dims=None):
+        """Halves data until the estimate of every part fits the budget.
+
+        The parts keep the padded dimensions of the whole batch, so running
+        them separately gives the same results as running the batch at once.
+        A single item is never split further, even if it exceeds the budget.
+        """
+        if not self.has(mode):
+            return [data]
+        dims = dict(dims or batch_dims(data))
+        dims['batch_size'] = len(data)
+        if len(data) == 1 or self.estimate(mode, dims) <= budget:
+            return [data]
+        half = len(data) // 2
+        return self.split(data[:half], mode, budget, dims) + self.split(data[half:], mode, budget, dims)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(json.dumps({'num_symbols': self.num_symbols,
+                'num_units': self.num_units,
+                'num_trans_units': self.num_trans_units,
+                'coefficients': self.coefficients}) + '\n')
+
+    @classmethod
+    def load(cls, path, num_symbols, num_units, num_trans_units):
+        # coefficients fitted for another model size do not carry over
+        memory_model = cls(num_symbols, num_units, num_trans_units)
+        if os.path.exists(path):
+            with open(path) as f:
+                d = json.loads(f.readline())
+            if (d['num_symbols'], d['num_units'], d['num_trans_units']) == (num_symbols, num_units, num_trans_units):
+                memory_model.coefficients = d['coefficients']
+        return memory_model
@@ -1,15 +1,20 @@
+import contextlib
+import re
 import numpy as np
 import tensorflow as tf
 
 from tensorflow.python.ops.nn import dynamic_rnn
-from tensorflow.contrib.rnn import GRUCell, LSTMCell, MultiRNNCell
+from tensorflow.contrib.rnn import GRUCell, LSTMCell, MultiRNNCell, GRUBlockCell, LSTMBlockCell
 from tensorflow.contrib.seq2seq.python.ops.loss import sequence_loss
 from tensorflow.contrib.lookup.lookup_ops import MutableHashTable
 from tensorflow.contrib.layers.python.layers import layers
 from dynamic_decoder import dynamic_rnn_decoder
-from output_projection import output_projection_layer
+from output_projection import output_projection_layer, shortlist_output_fn
 from attention_decoder import * 
+from quantization import QuantizedGRUCell
+from tensorflow.python.util import nest
 from tensorflow.contrib.session_bundle import exporter
+from tensorflow.contrib.compiler import jit
 
 PAD_ID = 0
 UNK_ID = 1
@@ -18,6 +23,34 @@ EOS_ID = 3
 NONE_ID = 0
 _START_VOCAB = ['_PAD', '_UNK', '_GO', '_EOS']
 
+# GRUCell and GRUBlockCell share the gate layout (r, u = split(gates)) and
+# differ only in variable names, so checkpoints convert by renaming
+_GRU_BLOCK_CELL_NAMES = [
+        ('gru_cell/gates/kernel', 'GRUBlockCell/w_ru'),
+        ('gru_cell/gates/bias', 'GRUBlockCell/b_ru'),
+        ('gru_cell/candidate/kernel', 'GRUBlockCell/w_c'),
+        ('gru_cell/candidate/bias', 'GRUBlockCell/b_c')]
+
+def block_cell_variable_name(name, to_block=True):
+    # GRUCell before TF 1.3 names its variables weights/biases
+    name = re.sub(r'(gru_cell/(gates|candidate))/weights(?=/|$)', r'\1/kernel', name)
+    name = re.sub(r'(gru_cell/(gates|candidate))/biases(?=/|$)', r'\1/bias', name)
+    for gru_name, block_name in _GRU_BLOCK_CELL_NAMES:
+        src, dst = (gru_name, block_name) if to_block else (block_name, gru_name)
+        name = re.sub(r'/%s(?=/|$)' % src, '/' + dst, name)
+    return name
+
+@contextlib.contextmanager
+def _jit_scope(use_jit):
+    # ops created inside are compiled with XLA when use_jit is set; string
+    # ops and hash table lookups have no XLA kernels and stay outside. Off by
+    # default: its CPU training and decoding step times are not measured yet
+    if use_jit:
+        with jit.experimental_jit_scope():
+            yield
+    else:
+        yield
+
 class Model(object):
     def __init__(self,
             num_symbols,
@@ -35,8 +68,44 @@ class Model(object):
             max_length=60,
             mem_use=True,
             output_alignments=True,
-            use_lstm=False):
+            use_lstm=False,
+            forward_only=False,
+            inference_decoder=True,
+            shared_posts=False,
+            sampling_decoder=False,
+            use_jit=False,
+            use_block_cells=False,
+            grad_accum_steps=1,
+            clip_micro_batches=False,
+            accumulate_gradients=False,
+            parallel_iterations=32,
+            quantized=False,
+            shortlist=False,
+            shortlist_fallback=0.,
+            recompute_attention=False,
+            swap_memory=False,
+            memory_dtype='float32',
+            num_transe_units=None,
+            teacher_top_k=0,
+            distill_weight=0.,
+            softmax_cutoffs=()):
         
+        if quantized and (use_lstm or not forward_only):
+            raise ValueError("Quantized models have GRU cells and no optimizer, build them with forward_only")
+        if quantized and shortlist:
+            raise ValueError("The shortlist needs the float output projection")
+        if softmax_cutoffs and (quantized or shortlist):
+            raise ValueError("Quantized models and the shortlist need the flat output projection")
+        if list(softmax_cutoffs) != sorted(set(softmax_cutoffs)) or any(not 0 < c < num_symbols for c in softmax_cutoffs):
+            raise ValueError("Softmax cutoffs must increase within the %d symbols, got %s" % (num_symbols, softmax_cutoffs))
+        if (teacher_top_k > 0 or distill_weight > 0) and not (output_alignments and mem_use):
+            raise ValueError("Distillation needs the triple alignments, build the models with output_alignments and mem_use")
+        # storage type of the knowledge embeddings and the attention memories;
+        # bfloat16 has no CPU kernels for their products in this TensorFlow
+        memory_dtype = tf.as_dtype(memory_dtype)
+        if memory_dtype not in (tf.float32, tf.float16):
+            raise ValueError("The memories are stored in float32 or float16, got %s" % memory_dtype.name)
+
         self.posts = tf.placeholder(tf.string, (None, None), 'enc_inps')  # batch*len
         self.posts_length = tf.placeholder(tf.int32, (None), 'enc_lens')  # batch
         self.responses = tf.placeholder(tf.string, (None, None), 'dec_inps')  # batch*len
@@ -47,6 +116,15 @@ class Model(object):
         self.posts_triple = tf.placeholder(tf.int32, (None, None, 1), 'enc_triples')  # batch
         self.responses_triple = tf.placeholder(tf.string, (None, None, 3), 'dec_triples')  # batch
         self.match_triples = tf.placeholder(tf.int32, (None, None, None), 'match_triples')  # batch
+        if shared_posts:
+            # several responses per post: index of the post of every response
+            self.responses_post = tf.placeholder(tf.int32, (None), 'dec_posts')  # batch
+        if distill_weight > 0:
+            # soft targets of a teacher on the same batch, see step_teacher
+            self.teacher_targets = [tf.placeholder(tf.float32, (None, None, None), 'teacher_word_probs'),  # batch*len*k
+                    tf.placeholder(tf.int32, (None, None, None), 'teacher_word_ids'),  # batch*len*k
+                    tf.placeholder(tf.float32, (None, None), 'teacher_selector'),  # batch*len
+                    tf.placeholder(tf.float32, (None, None, None, None), 'teacher_alignments')]  # batch*len*triple_num*triple_len
 
         encoder_batch_size, encoder_len = tf.unstack(tf.shape(self.posts))
         triple_num = tf.shape(self.triples)[1]
@@ -101,7 +179,8 @@ class Model(object):
             self.embed = tf.get_variable('word_embed', dtype=tf.float32, initializer=embed)
         if entity_embed is None:
             # initialize the embedding randomly
-            self.entity_trans = tf.get_variable('entity_embed', [num_entities, num_trans_units], tf.float32, trainable=False)
+            # the pretrained TransE vectors may be wider than num_trans_units
+            self.entity_trans = tf.get_variable('entity_embed', [num_entities, num_transe_units or num_trans_units], tf.float32, trainable=False)
         else:
             # initialize the embedding by pre-trained trans vectors
             self.entity_trans = tf.get_variable('entity_embed', dtype=tf.float32, initializer=entity_embed, trainable=False)
@@ -111,12 +190,15 @@ class Model(object):
 
         self.entity_embed = tf.concat([padding_entity, self.entity_trans_transformed], axis=0)
 
-        triples_embedding = tf.reshape(tf.nn.embedding_lookup(self.entity_embed, self.entity2index.lookup(self.triples)), [encoder_batch_size, triple_num, -1, 3 * num_trans_units])
-        entities_word_embedding = tf.reshape(tf.nn.embedding_lookup(self.embed, self.symbol2index.lookup(self.entities)), [encoder_batch_size, -1, num_embed_units])
+        # the triples and the entity words of the subgraphs live through the
+        # whole decoder loop, they are kept in memory_dtype; only the gathered
+        # rows are cast, not the tables
+        triples_embedding = tf.reshape(tf.cast(tf.nn.embedding_lookup(self.entity_embed, self.entity2index.lookup(self.triples)), memory_dtype), [encoder_batch_size, triple_num, -1, 3 * num_trans_units])
+        entities_word_embedding = tf.reshape(tf.cast(tf.nn.embedding_lookup(self.embed, self.symbol2index.lookup(self.entities)), memory_dtype), [encoder_batch_size, -1, num_embed_units])
 
-        head, relation, tail = tf.split(triples_embedding, [num_trans_units] * 3, axis=3)
+        head, relation, tail = tf.split(tf.cast(triples_embedding, tf.float32), [num_trans_units] * 3, axis=3)
 
-        with tf.variable_scope('graph_attention'):
+        with tf.variable_scope('graph_attention'), _jit_scope(use_jit):
             head_tail = tf.concat([head, tail], axis=3)
             head_tail_transformed = tf.layers.dense(head_tail, num_trans_units, activation=tf.tanh, name='head_tail_transform')
             relation_transformed = tf.layers.dense(relation, num_trans_units, name='relation_transform')
@@ -135,58 +217,146 @@ class Model(object):
         self.encoder_input = tf.concat([post_word_input, graph_embed_input], axis=2)
         self.decoder_input = tf.concat([response_word_input, triple_embed_input], axis=2)
 
-        encoder_cell = MultiRNNCell([GRUCell(num_units) for _ in range(num_layers)])
-        decoder_cell = MultiRNNCell([GRUCell(num_units) for _ in range(num_layers)])
+        def create_cell():
+            # block cells run each step as a single fused kernel
+            if quantized:
+                return QuantizedGRUCell(num_units)
+            if use_lstm:
+                return LSTMBlockCell(num_units) if use_block_cells else LSTMCell(num_units)
+            return GRUBlockCell(num_units) if use_block_cells else GRUCell(num_units)
+
+        encoder_cell = MultiRNNCell([create_cell() for _ in range(num_layers)])
+        decoder_cell = MultiRNNCell([create_cell() for _ in range(num_layers)])
         
         # rnn encoder
-        encoder_output, encoder_state = dynamic_rnn(encoder_cell, self.encoder_input, 
-                self.posts_length, dtype=tf.float32, scope="encoder")
+        with _jit_scope(use_jit):
+            encoder_output, encoder_state = dynamic_rnn(encoder_cell, self.encoder_input, 
+                    self.posts_length, dtype=tf.float32, parallel_iterations=parallel_iterations, swap_memory=swap_memory, scope="encoder")
 
         # get output projection function
-        output_fn, selector_fn, sequence_loss, sampled_sequence_loss, total_loss = output_projection_layer(num_units, 
-                num_symbols, num_samples)
+        output_fn, selector_fn, sequence_loss, sampled_sequence_loss, total_loss, distill_loss, soft_targets = output_projection_layer(num_units, 
+                num_symbols, num_samples, quantized=quantized, cutoffs=tuple(softmax_cutoffs))
 
         
 
-        with tf.variable_scope('decoder'):
+        with tf.variable_scope('decoder'), _jit_scope(use_jit):
             # get attention function
             attention_keys_init, attention_values_init, attention_score_fn_init, attention_construct_fn_init \
-                    = prepare_attention(encoder_output, 'bahdanau', num_units, imem=(graph_embed, triples_embedding), output_alignments=output_alignments and mem_use)#'luong', num_units)
+                    = prepare_attention(encoder_output, 'bahdanau', num_units, imem=(graph_embed, triples_embedding), output_alignments=output_alignments and mem_use, inline_scores=use_jit, quantized=quantized,
+                            recompute=recompute_attention and not forward_only, memory_dtype=memory_dtype)#'luong', num_units)
+
+            decoder_state_init = encoder_state
+            if shared_posts:
+                # encoder outputs and memory keys are computed once per post
+                # and handed to each of its responses
+                gather_posts = lambda x: tf.gather(x, self.responses_post)
+                attention_keys_init = nest.map_structure(gather_posts, attention_keys_init)
+                attention_values_init = nest.map_structure(gather_posts, attention_values_init)
+                decoder_state_init = nest.map_structure(gather_posts, encoder_state)
 
             decoder_fn_train = attention_decoder_fn_train(
-                    encoder_state, attention_keys_init, attention_values_init,
+                    decoder_state_init, attention_keys_init, attention_values_init,
                     attention_score_fn_init, attention_construct_fn_init, output_alignments=output_alignments and mem_use, max_length=tf.reduce_max(self.responses_length))
             self.decoder_output, _, alignments_ta = dynamic_rnn_decoder(decoder_cell, decoder_fn_train, 
-                    self.decoder_input, self.responses_length, scope="decoder_rnn")
+                    self.decoder_input, self.responses_length, parallel_iterations=parallel_iterations, swap_memory=swap_memory, scope="decoder_rnn")
             if output_alignments: 
                 self.alignments = tf.transpose(alignments_ta.stack(), perm=[1,0,2,3])
-                self.decoder_loss, self.ppx_loss, self.sentence_ppx = total_loss(self.decoder_output, self.responses_target, self.decoder_mask, self.alignments, triples_embedding, use_triples, one_hot_triples)
+                if distill_weight > 0:
+                    self.decoder_loss, self.ppx_loss, self.sentence_ppx = distill_loss(self.decoder_output, self.responses_target, self.decoder_mask, self.alignments, triples_embedding, use_triples, one_hot_triples,
+                            *(self.teacher_targets + [distill_weight]))
+                else:
+                    self.decoder_loss, self.ppx_loss, self.sentence_ppx = total_loss(self.decoder_output, self.responses_target, self.decoder_mask, self.alignments, triples_embedding, use_triples, one_hot_triples)
                 self.sentence_ppx = tf.identity(self.sentence_ppx, name='ppx_loss')
+                if teacher_top_k > 0:
+                    self.soft_targets = list(soft_targets(self.decoder_output, teacher_top_k)) + [self.alignments]
             else:
                 self.decoder_loss = sequence_loss(self.decoder_output, 
                         self.responses_target, self.decoder_mask)
          
-        with tf.variable_scope('decoder', reuse=True):
-            # get attention function
-            attention_keys, attention_values, attention_score_fn, attention_construct_fn \
-                    = prepare_attention(encoder_output, 'bahdanau', num_units, reuse=True, imem=(graph_embed, triples_embedding), output_alignments=output_alignments and mem_use)#'luong', num_units)
-            decoder_fn_inference = attention_decoder_fn_inference(
-                    output_fn, encoder_state, attention_keys, attention_values, 
-                    attention_score_fn, attention_construct_fn, self.embed, GO_ID, 
-                    EOS_ID, max_length, num_symbols, imem=(entities_word_embedding, tf.reshape(triples_embedding, [encoder_batch_size, -1, 3*num_trans_units])), selector_fn=selector_fn)
+        # per-example cap on the decoding steps, max_length unless fed
+        self.max_decode_length = tf.placeholder_with_default(tf.fill([encoder_batch_size], max_length), (None), 'max_dec_lens')  # batch
+
+        if inference_decoder:
+            if shortlist:
+                # symbols the greedy decoder may emit for this batch, all unless fed
+                self.shortlist = tf.placeholder_with_default(tf.range(num_symbols), (None), 'shortlist')
+            with tf.variable_scope('decoder', reuse=True):
+                output_fn_greedy, greedy_options = output_fn, {}
+                if shortlist:
+                    output_fn_greedy = shortlist_output_fn(num_units, num_symbols, self.shortlist)
+                    greedy_options = {'shortlist': self.shortlist,
+                            'full_output_fn': output_fn,
+                            'fallback_threshold': shortlist_fallback}
+                with _jit_scope(use_jit):
+                    # get attention function
+                    attention_keys, attention_values, attention_score_fn, attention_construct_fn \
+                            = prepare_attention(encoder_output, 'bahdanau', num_units, reuse=True, imem=(graph_embed, triples_embedding), output_alignments=output_alignments and mem_use, inline_scores=use_jit, quantized=quantized, memory_dtype=memory_dtype)#'luong', num_units)
+                    # the encoder side of the greedy decoder, feeding these
+                    # skips the encoder (see inference_cache.CachedGenerator)
+                    self.encoder_cache_tensors = nest.flatten([encoder_state, attention_keys, attention_values])
+                    # the parts of those that depend on the triples of each
+                    # subgraph only: [batch_size, triple_num(, triple_len), units]
+                    self.subgraph_tensors = [graph_embed, attention_keys[1], attention_values[1], attention_keys[2], attention_values[2]]
+                    decoder_fn_inference = attention_decoder_fn_inference(
+                            output_fn_greedy, encoder_state, attention_keys, attention_values, 
+                            attention_score_fn, attention_construct_fn, self.embed, GO_ID, 
+                            EOS_ID, self.max_decode_length, num_symbols, imem=(entities_word_embedding, tf.reshape(triples_embedding, [encoder_batch_size, -1, 3*num_trans_units])), selector_fn=selector_fn,
+                            **greedy_options)
 
                 
-            self.decoder_distribution, _, output_ids_ta = dynamic_rnn_decoder(decoder_cell,
-                    decoder_fn_inference, scope="decoder_rnn")
-
-            output_len = tf.shape(self.decoder_distribution)[1]
-            output_ids = tf.transpose(output_ids_ta.gather(tf.range(output_len)))
-            word_ids = tf.cast(tf.clip_by_value(output_ids, 0, num_symbols), tf.int64)
-            entity_ids = tf.reshape(tf.clip_by_value(-output_ids, 0, num_symbols) + tf.reshape(tf.range(encoder_batch_size) * tf.shape(entities_word_embedding)[1], [-1, 1]), [-1])
-            entities = tf.reshape(tf.gather(tf.reshape(self.entities, [-1]), entity_ids), [-1, output_len])
-            words = self.index2symbol.lookup(word_ids)
-            self.generation = tf.where(output_ids > 0, words, entities)
-            self.generation = tf.identity(self.generation, name='generation')
+                    self.decoder_distribution, _, output_ids_ta = dynamic_rnn_decoder(decoder_cell,
+                            decoder_fn_inference, parallel_iterations=parallel_iterations, scope="decoder_rnn")
+
+                    # a single step of the same decoder for streaming, see
+                    # streaming.py: the cell state of the previous step is fed
+                    # in place of encoder_state (with the memories in place of
+                    # the rest of encoder_cache_tensors) and its next input in
+                    # place of stream_input, the input of the first step
+                    self.stream_input = decoder_fn_inference(0, None, None, None, None)[2]
+                    self.stream_time = tf.placeholder(tf.int32, (), 'stream_time')
+                    with tf.variable_scope('decoder_rnn'):
+                        stream_output, stream_state = decoder_cell(self.stream_input, encoder_state)
+                    self.stream_done, _, self.stream_next_input, _, stream_ids_ta = decoder_fn_inference(self.stream_time,
+                            stream_state, None, stream_output, tf.TensorArray(tf.int32, size=1, dynamic_size=True, infer_shape=False))
+                    stream_ids = tf.reshape(stream_ids_ta.read(self.stream_time - 1), [-1, 1])
+                    self.stream_state_tensors = nest.flatten(encoder_state)
+                    self.stream_state = nest.flatten(stream_state)
+
+                output_len = tf.shape(self.decoder_distribution)[1]
+                output_ids = tf.transpose(output_ids_ta.gather(tf.range(output_len)))
+                self.generation = self._ids_to_tokens(output_ids, self.entities, num_symbols)
+                self.generation, self.truncated = self._cap_tokens(output_ids, self.generation, self.max_decode_length)
+                self.generation = tf.identity(self.generation, name='generation')
+                self.truncated = tf.identity(self.truncated, name='truncated')
+                self.stream_tokens = self._ids_to_tokens(stream_ids, self.entities, num_symbols)[:, 0]
+
+        if sampling_decoder:
+            self.num_responses = tf.placeholder_with_default(1, (), 'num_responses')
+            self.temperature = tf.placeholder_with_default(1.0, (), 'temperature')
+            self.top_k = tf.placeholder_with_default(0, (), 'top_k')
+            self.top_p = tf.placeholder_with_default(1.0, (), 'top_p')
+            with tf.variable_scope('decoder', reuse=True):
+                # the encoder and the memories are prepared once per post and
+                # shared by its samples, only the decoder state is tiled
+                # across them
+                attention_keys, attention_values, attention_score_fn, attention_construct_fn \
+                        = prepare_attention(encoder_output, 'bahdanau', num_units, reuse=True, imem=(graph_embed, triples_embedding), output_alignments=output_alignments and mem_use, inline_scores=use_jit, quantized=quantized, memory_dtype=memory_dtype)
+                sample_posts = tf.reshape(tf.tile(tf.reshape(tf.range(encoder_batch_size), [-1, 1]), [1, self.num_responses]), [-1])
+                tile_samples = lambda x: tf.gather(x, sample_posts)
+                decoder_fn_sample = attention_decoder_fn_inference(
+                        output_fn, nest.map_structure(tile_samples, encoder_state), attention_keys, attention_values,
+                        attention_score_fn, attention_construct_fn, self.embed, GO_ID,
+                        EOS_ID, tile_samples(self.max_decode_length), num_symbols, imem=(entities_word_embedding, tf.reshape(triples_embedding, [encoder_batch_size, -1, 3*num_trans_units])), selector_fn=selector_fn,
+                        sample_fn=create_sample_fn(self.temperature, self.top_k, self.top_p), samples_per_post=self.num_responses)
+
+                sample_distribution, _, sample_ids_ta = dynamic_rnn_decoder(decoder_cell,
+                        decoder_fn_sample, parallel_iterations=parallel_iterations, scope="decoder_rnn")
+
+                sample_len = tf.shape(sample_distribution)[1]
+                sample_ids = tf.transpose(sample_ids_ta.gather(tf.range(sample_len)))
+                self.sample_generation = self._ids_to_tokens(sample_ids, self.entities, num_symbols, entity_rows=sample_posts)
+                self.sample_generation, self.sample_truncated = self._cap_tokens(sample_ids, self.sample_generation, tile_samples(self.max_decode_length))
+                self.sample_generation = tf.identity(self.sample_generation, name='sample_generation')
         
 
         # initialize the training process
@@ -197,15 +367,25 @@ class Model(object):
         self.global_step = tf.Variable(0, trainable=False)
 
         self.params = tf.global_variables()
+        self.accumulate = None
             
-        opt = tf.train.AdamOptimizer(learning_rate=learning_rate)
-        self.lr = opt._lr
-       
-        gradients = tf.gradients(self.decoder_loss, self.params)
-        clipped_gradients, self.gradient_norm = tf.clip_by_global_norm(gradients, 
-                max_gradient_norm)
-        self.update = opt.apply_gradients(zip(clipped_gradients, self.params), 
-                global_step=self.global_step)
+        # a forward-only graph (e.g. for the evaluator) has no optimizer slots,
+        # restoring it from a training checkpoint simply skips them
+        if not forward_only:
+            opt = tf.train.AdamOptimizer(learning_rate=learning_rate)
+            self.lr = opt._lr
+           
+            gradients = tf.gradients(self.decoder_loss, self.params)
+            self.batch_gradient_norm = tf.global_norm(gradients)
+            if grad_accum_steps == 1 and not accumulate_gradients:
+                clipped_gradients, self.gradient_norm = tf.clip_by_global_norm(gradients, 
+                        max_gradient_norm)
+                self.update = opt.apply_gradients(zip(clipped_gradients, self.params), 
+                        global_step=self.global_step)
+            else:
+                self._build_accumulation(opt, gradients, max_gradient_norm, clip_micro_batches)
+        self.grad_accum_steps = grad_accum_steps
+        self.batches = 0
 
         tf.summary.scalar('decoder_loss', self.decoder_loss)
         for each in tf.trainable_variables():
@@ -218,11 +398,61 @@ class Model(object):
         self.saver_epoch = tf.train.Saver(write_version=tf.train.SaverDef.V2, max_to_keep=1000, pad_step_number=True)
 
 
+    def _build_accumulation(self, opt, gradients, max_gradient_norm, clip_micro_batches):
+        # Gradients are summed into accumulators, each batch weighted by
+        # gradient_weight (1/grad_accum_steps, less for the parts of a split
+        # batch), and the sum is applied as one update: self.accumulate adds
+        # a batch, self.update applies the sum and resets the accumulators.
+        self.gradient_weight = tf.placeholder_with_default(1.0, (), 'gradient_weight')
+        params, gradients = zip(*[(p, g) for p, g in zip(self.params, gradients) if g is not None])
+        if clip_micro_batches:
+            gradients, _ = tf.clip_by_global_norm(gradients, max_gradient_norm)
+        accumulators = [tf.Variable(tf.zeros(p.get_shape(), dtype=p.dtype.base_dtype), trainable=False,
+            collections=[tf.GraphKeys.LOCAL_VARIABLES], name='%s_accumulator' % p.op.name.replace('/', '_')) for p in params]
+        accumulate_ops = []
+        for accumulator, gradient in zip(accumulators, gradients):
+            if isinstance(gradient, tf.IndexedSlices):
+                # embedding gradients only touch the looked-up rows
+                accumulate_ops.append(tf.scatter_add(accumulator, gradient.indices, gradient.values * self.gradient_weight))
+            else:
+                accumulate_ops.append(tf.assign_add(accumulator, gradient * self.gradient_weight))
+        self.accumulate = tf.group(*accumulate_ops)
+
+        summed_gradients = [accumulator.read_value() for accumulator in accumulators]
+        if clip_micro_batches:
+            clipped_gradients, self.gradient_norm = summed_gradients, tf.global_norm(summed_gradients)
+        else:
+            clipped_gradients, self.gradient_norm = tf.clip_by_global_norm(summed_gradients, max_gradient_norm)
+        apply_op = opt.apply_gradients(zip(clipped_gradients, params), global_step=self.global_step)
+        with tf.control_dependencies([apply_op]):
+            self.update = tf.group(*[tf.assign(accumulator, tf.zeros_like(accumulator)) for accumulator in accumulators])
+
+    def _ids_to_tokens(self, output_ids, entities, num_symbols, entity_rows=None):
+        # positive ids are words, negative ids index the flattened entities of
+        # each row, or of its row of entities in entity_rows
+        output_len = tf.shape(output_ids)[1]
+        entities_num = tf.shape(entities)[1] * tf.shape(entities)[2]
+        if entity_rows is None:
+            entity_rows = tf.range(tf.shape(output_ids)[0])
+        word_ids = tf.cast(tf.clip_by_value(output_ids, 0, num_symbols), tf.int64)
+        entity_ids = tf.reshape(tf.clip_by_value(-output_ids, 0, num_symbols) + tf.reshape(entity_rows * entities_num, [-1, 1]), [-1])
+        entities = tf.reshape(tf.gather(tf.reshape(entities, [-1]), entity_ids), [-1, output_len])
+        words = self.index2symbol.lookup(word_ids)
+        return tf.where(output_ids > 0, words, entities)
+
+    def _cap_tokens(self, output_ids, tokens, caps):
+        # rows keep being decoded after their cap while other rows run, end
+        # them there and report the rows that were cut before emitting _EOS
+        within_cap = tf.less_equal(tf.reshape(tf.range(tf.shape(output_ids)[1]), [1, -1]), tf.reshape(caps, [-1, 1]))
+        truncated = tf.logical_not(tf.reduce_any(tf.logical_and(tf.equal(output_ids, EOS_ID), within_cap), axis=1))
+        tokens = tf.where(within_cap, tokens, tf.fill(tf.shape(tokens), '_EOS'))
+        return tokens, truncated
+
     def print_parameters(self):
         for item in self.params:
             print('%s: %s' % (item.name, item.get_shape()))
     
-    def step_decoder(self, session, data, forward_only=False, summary=False):
+    def step_decoder(self, session, data, forward_only=False, summary=False, gradient_weight=1.0, end_of_batch=True, soft_targets=None):
         input_feed = {self.posts: data['posts'],
                 self.posts_length: data['posts_length'],
                 self.responses: data['responses'],
@@ -231,11 +461,63 @@ class Model(object):
                 self.posts_triple: data['posts_triple'],
                 self.responses_triple: data['responses_triple'],
                 self.match_triples: data['match_triples']}
+        if soft_targets is not None:
+            # from step_teacher of the teacher on the same batch
+            input_feed.update(zip(self.teacher_targets, soft_targets))
 
         if forward_only:
             output_feed = [self.sentence_ppx]
+        elif self.accumulate is not None:
+            # a batch, or a part of one weighted by gradient_weight, is only
+            # accumulated; the update follows every grad_accum_steps batches and
+            # the gradient norm is None until then
+            input_feed[self.gradient_weight] = gradient_weight / self.grad_accum_steps
+            outputs = session.run([self.sentence_ppx, self.accumulate], input_feed)
+            gradient_norm = None
+            if end_of_batch:
+                self.batches += 1
+                if self.batches % self.grad_accum_steps == 0:
+                    gradient_norm = session.run([self.gradient_norm, self.update])[0]
+            return [outputs[0], gradient_norm, None]
         else:
             output_feed = [self.sentence_ppx, self.gradient_norm, self.update]
         if summary:
             output_feed.append(self.merged_summary_op)
         return session.run(output_feed, input_feed)
+
+    def step_teacher(self, session, data):
+        input_feed = {self.posts: data['posts'],
+                self.posts_length: data['posts_length'],
+                self.responses: data['responses'],
+                self.responses_length: data['responses_length'],
+                self.triples: data['triples'],
+                self.posts_triple: data['posts_triple'],
+                self.responses_triple: data['responses_triple'],
+                self.match_triples: data['match_triples']}
+        return session.run(self.soft_targets, input_feed)
+
+    def step_scorer(self, session, data):
+        input_feed = {self.posts: data['posts'],
+                self.posts_length: data['posts_length'],
+                self.responses: data['responses'],
+                self.responses_length: data['responses_length'],
+                self.triples: data['triples'],
+                self.posts_triple: data['posts_triple'],
+                self.responses_triple: data['responses_triple'],
+                self.match_triples: data['match_triples'],
+                self.responses_post: data['responses_post']}
+        return session.run(self.sentence_ppx, input_feed)
+
+    def step_sampler(self, session, data, num_responses=1, temperature=1.0, top_k=0, top_p=1.0, max_decode_length=None):
+        input_feed = {self.posts: data['posts'],
+                self.posts_length: data['posts_length'],
+                self.triples: data['triples'],
+                self.posts_triple: data['posts_triple'],
+                self.entities: data['entities'],
+                self.num_responses: num_responses,
+                self.temperature: temperature,
+                self.top_k: top_k,
+                self.top_p: top_p}
+        if max_decode_length is not None:
+            input_feed[self.max_decode_length] = max_decode_length
+        return session.run([self.sample_generation, self.sample_truncated], input_feed)
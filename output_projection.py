@@ -1,10 +1,59 @@
 import tensorflow as tf
 from tensorflow.contrib.layers.python.layers import layers
 from tensorflow.python.ops import variable_scope
+import quantization
 
-def output_projection_layer(num_units, num_symbols, num_samples=None, name="output_projection"):
+def _tail_logits(outputs, cluster, size, scope):
+    # tail cluster i scores its words from the outputs narrowed to num_units / 4**(i+1)
+    num_units = outputs.get_shape()[-1].value
+    projected = layers.linear(outputs, max(num_units // 4**(cluster+1), 1), biases_initializer=None,
+            scope='%s/tail_%d/projection' % (scope, cluster))
+    return layers.linear(projected, size, scope='%s/tail_%d/output' % (scope, cluster))
+
+def adaptive_log_probs(outputs, num_symbols, cutoffs, scope):
+    """Log probabilities of all the symbols under an adaptive softmax.
+
+    The symbols are sorted by frequency. The head scores the cutoffs[0] most
+    frequent ones and one logit per tail cluster, the symbols from cutoffs[i]
+    to cutoffs[i+1] (or num_symbols), which are scored from narrower
+    projections of the outputs (see _tail_logits). The log probability of a
+    tail symbol is that of its cluster in the head plus its own in the
+    cluster.
+    """
+    bounds = list(cutoffs) + [num_symbols]
+    head = tf.nn.log_softmax(layers.linear(outputs, cutoffs[0] + len(cutoffs), scope='%s/head' % scope))
+    head_words, head_clusters = tf.split(head, [cutoffs[0], len(cutoffs)], axis=-1)
+    log_probs = [head_words]
+    for i in range(len(cutoffs)):
+        log_probs.append(head_clusters[..., i:i+1] + tf.nn.log_softmax(_tail_logits(outputs, i, bounds[i+1] - bounds[i], scope)))
+    return tf.concat(log_probs, axis=-1)
+
+def adaptive_target_log_probs(outputs, targets, num_symbols, cutoffs, scope):
+    # log probabilities of the targets under adaptive_log_probs, a tail
+    # cluster is scored for the outputs whose target falls in it only
+    bounds = list(cutoffs) + [num_symbols]
+    num_units = outputs.get_shape()[-1].value
+    shape = tf.shape(targets)
+    outputs = tf.reshape(outputs, [-1, num_units])
+    targets = tf.reshape(tf.cast(targets, tf.int32), [-1])
+    clusters = tf.add_n([tf.cast(tf.greater_equal(targets, cutoff), tf.int32) for cutoff in cutoffs])
+    head = tf.nn.log_softmax(layers.linear(outputs, cutoffs[0] + len(cutoffs), scope='%s/head' % scope))
+    head_ids = tf.where(tf.equal(clusters, 0), targets, cutoffs[0] + clusters - 1)
+    log_probs = tf.reduce_sum(head * tf.one_hot(head_ids, cutoffs[0] + len(cutoffs)), axis=1)
+    for i in range(len(cutoffs)):
+        rows = tf.where(tf.equal(clusters, i + 1))
+        tail = tf.nn.log_softmax(_tail_logits(tf.gather_nd(outputs, rows), i, bounds[i+1] - bounds[i], scope))
+        tail_log_probs = tf.reduce_sum(tail * tf.one_hot(tf.gather_nd(targets, rows) - bounds[i], bounds[i+1] - bounds[i]), axis=1)
+        log_probs += tf.scatter_nd(rows, tail_log_probs, tf.shape(log_probs, out_type=tf.int64))
+    return tf.reshape(log_probs, shape)
+
+def output_projection_layer(num_units, num_symbols, num_samples=None, name="output_projection", quantized=False, cutoffs=()):
+    # with cutoffs the words are scored by an adaptive softmax (see
+    # adaptive_log_probs) and the logits are its log probabilities
     def output_fn(outputs):
-        return layers.linear(outputs, num_symbols, scope=name)
+        if cutoffs:
+            return adaptive_log_probs(outputs, num_symbols, cutoffs, name)
+        return quantization.linear(outputs, num_symbols, scope=name, quantized=quantized)
 
     def selector_fn(outputs):
         selector = tf.sigmoid(layers.linear(outputs, 1, scope='selector'))
@@ -12,12 +61,15 @@ def output_projection_layer(num_units, num_symbols, num_samples=None, name="outp
 
     def sequence_loss(outputs, targets, masks):
         with variable_scope.variable_scope('decoder_rnn'):
-            logits = layers.linear(outputs, num_symbols, scope=name)
-            logits = tf.reshape(logits, [-1, num_symbols])
             local_labels = tf.reshape(targets, [-1])
             local_masks = tf.reshape(masks, [-1])
             
-            local_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=local_labels, logits=logits)
+            if cutoffs:
+                local_loss = - tf.reshape(adaptive_target_log_probs(outputs, targets, num_symbols, cutoffs, name), [-1])
+            else:
+                logits = quantization.linear(outputs, num_symbols, scope=name, quantized=quantized)
+                logits = tf.reshape(logits, [-1, num_symbols])
+                local_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=local_labels, logits=logits)
             local_loss = local_loss * local_masks
             
             loss = tf.reduce_sum(local_loss)
@@ -45,14 +97,23 @@ def output_projection_layer(num_units, num_symbols, num_samples=None, name="outp
             
             return loss / total_size
     
-    def total_loss(outputs, targets, masks, alignments, triples_embedding, use_entities, entity_targets):
-        batch_size = tf.shape(outputs)[0]
+    def mixture_selector(outputs):
+        return tf.squeeze(tf.sigmoid(layers.linear(outputs, 1, scope='decoder_rnn/selector')))
+
+    def mixture(outputs):
+        # word logits and selector of the decoder outputs
+        if cutoffs:
+            logits = adaptive_log_probs(outputs, num_symbols, cutoffs, 'decoder_rnn/%s' % name)
+        else:
+            logits = quantization.linear(outputs, num_symbols, scope='decoder_rnn/%s' % name, quantized=quantized)
+        return logits, mixture_selector(outputs)
+
+    def target_word_prob(logits, targets):
+        return tf.reduce_sum(tf.nn.softmax(logits) * tf.one_hot(targets, num_symbols), axis=2)
+
+    def mixture_loss(word_prob, selector, targets, masks, alignments, use_entities, entity_targets):
+        batch_size = tf.shape(word_prob)[0]
         local_masks = tf.reshape(masks, [-1])
-        
-        logits = layers.linear(outputs, num_symbols, scope='decoder_rnn/%s' % name)
-        one_hot_targets = tf.one_hot(targets, num_symbols)
-        word_prob = tf.reduce_sum(tf.nn.softmax(logits) * one_hot_targets, axis=2)
-        selector = tf.squeeze(tf.sigmoid(layers.linear(outputs, 1, scope='decoder_rnn/selector')))
 
         triple_prob = tf.reduce_sum(alignments * entity_targets, axis=[2, 3])
         ppx_prob = word_prob * (1 - use_entities) + triple_prob * use_entities
@@ -68,7 +129,75 @@ def output_projection_layer(num_units, num_symbols, num_samples=None, name="outp
         
         return loss / total_size, ppx_loss / total_size, sentence_ppx / tf.reduce_sum(masks, axis=1)
 
+    def total_loss(outputs, targets, masks, alignments, triples_embedding, use_entities, entity_targets):
+        if cutoffs:
+            # only the clusters of the targets are scored
+            word_prob = tf.exp(adaptive_target_log_probs(outputs, targets, num_symbols, cutoffs, 'decoder_rnn/%s' % name))
+            selector = mixture_selector(outputs)
+        else:
+            logits, selector = mixture(outputs)
+            word_prob = target_word_prob(logits, targets)
+        return mixture_loss(word_prob, selector, targets, masks, alignments, use_entities, entity_targets)
 
+    def distill_loss(outputs, targets, masks, alignments, triples_embedding, use_entities, entity_targets,
+            teacher_word_probs, teacher_word_ids, teacher_selector, teacher_alignments, distill_weight):
+        """total_loss mixed with the cross entropy against the output distribution of a teacher.
 
-    return output_fn, selector_fn, sequence_loss, sampled_sequence_loss, total_loss
-    
+        The output distribution is a mixture of the words, weighted 1 - selector,
+        and the triples, weighted selector. Its cross entropy with the teacher's
+        is the binary cross entropy of the selectors plus those of the word and
+        triple distributions, weighted by the teacher's selector. The teacher's
+        word distribution comes as its top k words (see soft_targets),
+        renormalized. The perplexities are those of total_loss.
+        """
+        batch_size, decoder_len = tf.shape(outputs)[0], tf.shape(outputs)[1]
+        local_masks = tf.reshape(masks, [-1])
+        logits, selector = mixture(outputs)
+        loss, ppx_loss, sentence_ppx = mixture_loss(target_word_prob(logits, targets), selector, targets, masks, alignments, use_entities, entity_targets)
+
+        # log probabilities of the teacher's top words: [batch_size, decoder_len, k]
+        word_offsets = tf.reshape(tf.range(batch_size * decoder_len) * num_symbols, [batch_size, decoder_len, 1])
+        log_word_prob = tf.gather(tf.reshape(tf.nn.log_softmax(logits), [-1]), teacher_word_ids + word_offsets)
+        teacher_word_probs = teacher_word_probs / (1e-12 + tf.reduce_sum(teacher_word_probs, axis=2, keep_dims=True))
+        word_loss = - tf.reduce_sum(teacher_word_probs * log_word_prob, axis=2)
+        triple_loss = - tf.reduce_sum(teacher_alignments * tf.log(1e-12 + alignments), axis=[2, 3])
+        selector_loss = - teacher_selector * tf.log(1e-12 + selector) - (1 - teacher_selector) * tf.log(1e-12 + 1 - selector)
+        soft_loss = (1 - teacher_selector) * word_loss + teacher_selector * triple_loss + selector_loss
+        soft_loss = tf.reduce_sum(tf.reshape(soft_loss, [-1]) * local_masks) / (tf.reduce_sum(local_masks) + 1e-12)
+
+        return (1 - distill_weight) * loss + distill_weight * soft_loss, ppx_loss, sentence_ppx
+
+    def soft_targets(outputs, top_k):
+        # the teacher's side of distill_loss: the top_k words of its word
+        # distribution with their probabilities and its selector, on the
+        # variables of total_loss
+        with variable_scope.variable_scope(variable_scope.get_variable_scope(), reuse=True):
+            logits, selector = mixture(outputs)
+        word_probs, word_ids = tf.nn.top_k(tf.nn.softmax(logits), top_k)
+        return word_probs, word_ids, selector
+
+    return output_fn, selector_fn, sequence_loss, sampled_sequence_loss, total_loss, distill_loss, soft_targets
+
+def shortlist_output_fn(num_units, num_symbols, shortlist, name="output_projection"):
+    """output_fn over the columns of the shortlisted symbols and one more for the rest.
+
+    The last logit is the mean logit of the symbols outside the shortlist
+    plus the log of their number, a lower bound (by Jensen) of the log of
+    their summed exponentials. Its softmax probability estimates the mass
+    the shortlist misses, and the shortlisted probabilities approximate
+    their full-vocabulary ones. The columns are gathered once, outside the
+    decoding loop.
+    """
+    with variable_scope.variable_scope('decoder_rnn/%s' % name, reuse=True):
+        all_weights = tf.transpose(tf.get_variable("weights", [num_units, num_symbols]))
+        all_biases = tf.get_variable("biases", [num_symbols])
+        weights = tf.gather(all_weights, shortlist)
+        biases = tf.gather(all_biases, shortlist)
+        num_others = tf.cast(num_symbols - tf.size(shortlist), tf.float32)
+        other_weights = (tf.reduce_sum(all_weights, 0) - tf.reduce_sum(weights, 0)) / tf.maximum(num_others, 1.)
+        other_bias = (tf.reduce_sum(all_biases) - tf.reduce_sum(biases)) / tf.maximum(num_others, 1.) + tf.log(tf.maximum(num_others, 1e-12))
+        weights = tf.concat([weights, tf.expand_dims(other_weights, 0)], 0)
+        biases = tf.concat([biases, tf.expand_dims(other_bias, 0)], 0)
+    def output_fn(outputs):
+        return tf.matmul(outputs, weights, transpose_b=True) + biases
+    return output_fn
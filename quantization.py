@@ -0,0 +1,101 @@
+import re
+
+import numpy as np
+import tensorflow as tf
+
+from tensorflow.contrib.layers.python.layers import layers
+from tensorflow.contrib.rnn import RNNCell
+from tensorflow.python.ops import gen_array_ops
+from tensorflow.python.ops import gen_math_ops
+from tensorflow.python.ops import init_ops
+from tensorflow.python.ops import variable_scope
+
+# kernels of the dense layers that dominate decoding: the vocabulary
+# projection, the attention output, the memory key projections and the GRU
+QUANTIZED_KERNELS = [
+        r'decoder_rnn/output_projection/weights$',
+        r'attention_construct/weights$',
+        r'(attention_keys|imem|imem_graph|imem_triple)/weights$',
+        r'gru_cell/(gates|candidate)/kernel$']
+
+def quantize_tensor(value):
+    """Quantizes a float array to quint8 over its range, which is widened to hold 0.
+
+    Follows FloatToQuantized of the MIN_FIRST mode, so the levels are those
+    QuantizedMatMul assumes for the returned range.
+    """
+    value_min = min(float(np.min(value)), 0.)
+    value_max = max(float(np.max(value)), value_min + 1e-6)
+    range_scale = 255. / (value_max - value_min)
+    quantized = np.round(value * range_scale) - np.round(value_min * range_scale)
+    return np.clip(quantized, 0, 255).astype(np.uint8), value_min, value_max
+
+def quantize_variable(name, value):
+    # the variables a quantized layer reads in place of the float kernel
+    if not any(re.search(pattern, name) for pattern in QUANTIZED_KERNELS):
+        return [(name, value)]
+    quantized, value_min, value_max = quantize_tensor(value)
+    return [('%s_quint8' % name, quantized),
+            ('%s_min' % name, np.float32(value_min)),
+            ('%s_max' % name, np.float32(value_max))]
+
+def quantized_matmul(inputs, weights, weights_min, weights_max):
+    # activations are quantized per call over their own range, widened to
+    # hold 0 so that zero padding and the initial attention stay exact
+    inputs_min = tf.minimum(tf.reduce_min(inputs), 0.)
+    inputs_max = tf.maximum(tf.maximum(tf.reduce_max(inputs), 0.), inputs_min + 1e-6)
+    quantized_inputs, inputs_min, inputs_max = gen_array_ops.quantize_v2(inputs,
+            inputs_min, inputs_max, tf.quint8, mode='MIN_FIRST')
+    outputs, outputs_min, outputs_max = gen_math_ops.quantized_mat_mul(quantized_inputs,
+            tf.bitcast(weights, tf.quint8), inputs_min, inputs_max, weights_min, weights_max,
+            Toutput=tf.qint32)
+    # the qint32 levels of a product are symmetric around 0
+    return tf.cast(tf.bitcast(outputs, tf.int32), tf.float32) * (outputs_max / 2147483647.)
+
+def _quantized_kernel(name, shape):
+    kernel = tf.get_variable('%s_quint8' % name, shape, tf.uint8,
+            initializer=init_ops.zeros_initializer(dtype=tf.uint8), trainable=False)
+    kernel_min = tf.get_variable('%s_min' % name, [], tf.float32, trainable=False)
+    kernel_max = tf.get_variable('%s_max' % name, [], tf.float32, trainable=False)
+    return kernel, kernel_min, kernel_max
+
+def linear(inputs, num_outputs, biases_initializer=init_ops.zeros_initializer(), scope=None, quantized=False):
+    """layers.linear, or the same layer on an int8 kernel written by quantize_variable."""
+    if not quantized:
+        return layers.linear(inputs, num_outputs, biases_initializer=biases_initializer, scope=scope)
+    with variable_scope.variable_scope(scope, 'fully_connected', [inputs]):
+        num_inputs = inputs.get_shape()[-1].value
+        outputs = quantized_matmul(tf.reshape(inputs, [-1, num_inputs]),
+                *_quantized_kernel('weights', [num_inputs, num_outputs]))
+        if biases_initializer is not None:
+            outputs += tf.get_variable('biases', [num_outputs], tf.float32)
+        return tf.reshape(outputs, tf.concat([tf.shape(inputs)[:-1], [num_outputs]], 0))
+
+
+class QuantizedGRUCell(RNNCell):
+    """GRUCell on int8 kernels, reading the variables quantize_variable writes for a GRUCell."""
+    def __init__(self, num_units, reuse=None):
+        super(QuantizedGRUCell, self).__init__(_reuse=reuse, name='gru_cell')
+        self._num_units = num_units
+
+    @property
+    def state_size(self):
+        return self._num_units
+
+    @property
+    def output_size(self):
+        return self._num_units
+
+    def call(self, inputs, state):
+        input_size = inputs.get_shape()[-1].value + self._num_units
+        with variable_scope.variable_scope('gates'):
+            gates = quantized_matmul(tf.concat([inputs, state], 1),
+                    *_quantized_kernel('kernel', [input_size, 2 * self._num_units]))
+            gates = tf.sigmoid(gates + tf.get_variable('bias', [2 * self._num_units], tf.float32))
+        r, u = tf.split(gates, 2, axis=1)
+        with variable_scope.variable_scope('candidate'):
+            candidate = quantized_matmul(tf.concat([inputs, r * state], 1),
+                    *_quantized_kernel('kernel', [input_size, self._num_units]))
+            candidate = tf.tanh(candidate + tf.get_variable('bias', [self._num_units], tf.float32))
+        new_h = u * state + (1 - u) * candidate
+        return new_h, new_h
@@ -0,0 +1,85 @@
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+import tensorflow as tf
+
+def settings_path(config_dir):
+    # one file per host, so a train_dir shared between machines keeps them apart
+    return '%s/session_%s.json' % (config_dir, socket.gethostname())
+
+def load_session_settings(config_dir, mode):
+    path = settings_path(config_dir)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.loads(f.readline()).get(mode, {})
+
+def save_session_settings(config_dir, mode, settings):
+    path = settings_path(config_dir)
+    all_settings = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            all_settings = json.loads(f.readline())
+    all_settings[mode] = settings
+    with open(path, 'w') as f:
+        f.write(json.dumps(all_settings) + '\n')
+
+def session_config(settings, config=None):
+    config = config or tf.ConfigProto()
+    config.intra_op_parallelism_threads = settings.get('intra_threads', 0)
+    config.inter_op_parallelism_threads = settings.get('inter_threads', 0)
+    # concurrent sessions in one process would otherwise share the thread pools
+    config.use_per_session_threads = settings.get('sessions', 1) > 1
+    return config
+
+def candidate_settings(num_cores=None):
+    """The settings swept by the autotuner.
+
+    The cores are divided between the concurrent sessions, each session's
+    share is used either by one wide op at a time or by a few narrower ones
+    in parallel. parallel_iterations bounds the steps of the encoder and
+    decoder loops that may run ahead of each other.
+    """
+    num_cores = num_cores or multiprocessing.cpu_count()
+    candidates = []
+    for sessions in [1, 2, 4]:
+        if sessions > num_cores:
+            continue
+        cores = num_cores // sessions
+        for inter_threads in [1, 2, 4]:
+            if inter_threads > cores:
+                continue
+            for parallel_iterations in [1, 8, 32]:
+                candidates.append({'sessions': sessions,
+                        'intra_threads': max(cores // inter_threads, 1),
+                        'inter_threads': inter_threads,
+                        'parallel_iterations': parallel_iterations})
+    return candidates
+
+def time_sessions(graph, settings, init_fn, step_fn, num_steps, warmup=1):
+    """Runs step_fn(sess, i) for i < num_steps in each of settings['sessions']
+    concurrent sessions on graph and returns the steps per second of all of them."""
+    sessions = [tf.Session(graph=graph, config=session_config(settings)) for _ in range(settings.get('sessions', 1))]
+    try:
+        for sess in sessions:
+            init_fn(sess)
+            for i in range(warmup):
+                step_fn(sess, i)
+        def run(sess):
+            for i in range(num_steps):
+                step_fn(sess, i)
+        threads = [threading.Thread(target=run, args=(sess, )) for sess in sessions]
+        start_time = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start_time
+    finally:
+        for sess in sessions:
+            sess.close()
+    return len(sessions) * num_steps / elapsed
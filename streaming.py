@@ -0,0 +1,86 @@
+import collections
+import time
+
+import numpy as np
+
+from memory_model import batch_dims
+
+class StreamingDecoder(object):
+    """Greedy decoding one step per run, so tokens can be served as they are chosen.
+
+    prepare runs the encoder and the memory projections of a batch once,
+    step runs a single step of the greedy decoder of the model (the cell,
+    the attention, the selector and the choice of a word or an entity) from
+    the state of the previous one. The steps are those of the decoding loop,
+    so the streamed tokens are its generation, copied entities included.
+
+    batch_fn(data, dims) builds the batch, feed_fn(data) returns extra feeds
+    such as decoding caps. The time to the first token of a batch and the
+    latency of every step are recorded, see metrics.
+    """
+    def __init__(self, model, sess, batch_fn, feed_fn=None):
+        self.model = model
+        self.sess = sess
+        self.batch_fn = batch_fn
+        self.feed_fn = feed_fn
+        self.tokens = 0
+        self.latency = collections.defaultdict(lambda: [0, .0])
+
+    def _timed(self, name, start_time):
+        self.latency[name][0] += 1
+        self.latency[name][1] += time.time() - start_time
+
+    def prepare(self, data):
+        # the feed of the steps of this batch and the input of the first one;
+        # the memories are fed at every step, so the encoder runs only here
+        model = self.model
+        batched_data = self.batch_fn(data, batch_dims(data))
+        input_feed = {model.posts: batched_data['posts'],
+                model.posts_length: batched_data['posts_length'],
+                model.triples: batched_data['triples'],
+                model.posts_triple: batched_data['posts_triple'],
+                model.entities: batched_data['entities']}
+        if self.feed_fn is not None:
+            input_feed.update(self.feed_fn(data))
+        outputs = self.sess.run(model.encoder_cache_tensors + [model.stream_input], input_feed)
+        input_feed.update(zip(model.encoder_cache_tensors, outputs[:-1]))
+        return input_feed, outputs[-1]
+
+    def step(self, input_feed, cell_input, step):
+        # step counts from 1; returns the token and whether it ends the row
+        # for every row and the input of the next step, input_feed takes the
+        # new cell state
+        model = self.model
+        input_feed[model.stream_input] = cell_input
+        input_feed[model.stream_time] = step
+        outputs = self.sess.run([model.stream_tokens, model.stream_done, model.stream_next_input] + model.stream_state, input_feed)
+        input_feed.update(zip(model.stream_state_tensors, outputs[3:]))
+        return outputs[0], outputs[1], outputs[2]
+
+    def stream(self, data):
+        """Yields the new token of every row after each step, None for rows
+        that are done or end with _EOS at this step."""
+        start_time = time.time()
+        input_feed, cell_input = self.prepare(data)
+        self._timed('prepare', start_time)
+        finished = np.zeros(len(data), dtype=bool)
+        step = 1
+        while not finished.all():
+            step_start_time = time.time()
+            tokens, done, cell_input = self.step(input_feed, cell_input, step)
+            self._timed('step', step_start_time)
+            if step == 1:
+                self._timed('first_token', start_time)
+            results = [None if finished[i] or token == '_EOS' else token for i, token in enumerate(tokens)]
+            self.tokens += len([token for token in results if token is not None])
+            finished |= done
+            step += 1
+            yield results
+
+    def metrics(self):
+        count, total = self.latency['step']
+        metrics = {'tokens': self.tokens,
+                'tokens_per_second': self.tokens / max(total, 1e-9)}
+        for name, (count, total) in self.latency.items():
+            metrics['%s_ms' % name] = total / max(count, 1) * 1000
+        return metrics